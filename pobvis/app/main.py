@@ -1,70 +1,85 @@
 """Style guide: use underscore for all variable and function names"""
-import requests
 import sys
 if sys.version_info.major < 3:
     raise Exception("User error: This application only supports Python 3, so please use python3 instead of python!")
 import json
-from flask import Flask, request, abort
+from flask import Flask, request, abort, Response, stream_with_context
 from flask_cors import CORS
-import tempfile
 import argparse
 import os
 
-from subprocess import PIPE, STDOUT, Popen, run, check_output
-from app.settings import DATABASE, MEDIA, PROSEBASEURL, options_for_visualization
+from app.settings import MEDIA, BATCHES, PARSE_WAIT, INTERN_EXPRS, options_for_visualization
 from app.utils.utils import *
 import app.utils.trace_parsing as ms
-import re
+import app.utils.storage as storage
+import app.utils.live as live
+import app.utils.metrics as metrics
+import app.utils.lemma_ast as lemma_ast
+import app.utils.lod as lod
+import app.utils.uploads as uploads
+import app.utils.responses as responses
+from app.utils.parse_workers import ParsePool, read_progress, compress_stored
+from app.utils.var_decls import get_declare_statements
+from app.utils.jobs import JobManager
+from app.utils.options import get_option_catalog
+from app.utils.prose import ProseClient, ProseError, lemma_cache_keys, get_cached_results, put_cached_results
 import hashlib
 import traceback
+import itertools
+import threading
+import shutil
+import concurrent.futures
 
 app = Flask(__name__)
 app.config.from_object(__name__)
 CORS(app)
+storage.init_app(app)
+metrics.init_app(app)
+responses.init_app(app)
+storage.migrate()
 
 parser = argparse.ArgumentParser(description='Run Spacer Server')
 parser.add_argument("-z3", "--z3", required=True, action="store", dest="z3_path", help="path to z3 python")
 args = parser.parse_args()
 
-def update_status():
-    exps_list = []
-    for exp in query_db('select * from exp where done is 0'):
-        r = {}
-        for k in exp.keys():
-            r[k] = exp[k]
-        exps_list.append(exp["exp_name"])
-    get_db().commit()
+jobs = JobManager()
+jobs.recover()
+prose = ProseClient()
+parse_pool = ParsePool()
+metrics.gauge("spacer_running_jobs", "Spacer processes running", jobs.running_count)
+metrics.gauge("spacer_queued_jobs", "Spacer runs waiting for a slot", jobs.queue.qsize)
+metrics.gauge("spacer_parses_in_flight", "Experiments being parsed by the parse workers", lambda: len(parse_pool.inflight))
 
 def delete_exp():
     print("call delete_exp")
     request_params = request.get_json()
     expr_name = request_params.get('expName', '')
 
-    delete_db("DELETE FROM exp WHERE exp_name = ?",(expr_name,) )
+    #only an existing experiment, whose folder is a direct child of MEDIA, is deleted
+    if expr_name in ("", ".", "..") or "/" in expr_name or os.sep in expr_name or (os.altsep and os.altsep in expr_name):
+        return json.dumps({'status': "Error: invalid experiment name {}".format(expr_name)})
+    if query_db('SELECT 1 FROM exp WHERE exp_name = ?', (expr_name,), one=True) is None:
+        return json.dumps({'status': "Error: no experiment {}".format(expr_name)})
+    exp_folder = os.path.realpath(os.path.join(MEDIA, expr_name))
+    if os.path.dirname(exp_folder) != os.path.realpath(MEDIA):
+        return json.dumps({'status': "Error: invalid experiment name {}".format(expr_name)})
+
+    delete_exp_rows(expr_name)
+    ms.drop_tail_parser(expr_name)
+    lod.forget_tree(expr_name)
+    #the folder of a run still going is left to it
+    if not jobs.is_running(expr_name):
+        shutil.rmtree(exp_folder, ignore_errors=True)
     return fetch_exps()
 
 
 
 def pooling():
-    return fetch_exps()
+    return fetch_exps(request.get_json(silent=True))
 
 def fetch_options(): 
-    test_args = [args.z3_path, "-p"]
-    output = check_output(test_args)
-    lines = output.decode("utf-8").split("\n")
-    result = parse_options(lines)
-    return json.dumps(result)
-
-def parse_options(lines):
-    result = []
-    prefix = ""
-    for line in lines:
-        if re.search("\[module\]\ ([a-zA-Z]+).*", line):
-            prefix = re.findall("\[module\]\ ([a-zA-Z]+).*", line)[0]
-        elif re.search("\ \ \ \ (.*)\ \((.*)\)\ \(default:\ (.*)\)", line):
-            details = re.findall("\ \ \ \ (.*)\ \((.*)\)\ \(default:\ (.*)\)", line)[0]
-            result.append({"name": (prefix if prefix == "" else prefix + ".") + details[0], "type": details[1], "default": details[2], "dash": True if prefix == "" else False})
-    return result
+    catalog = get_option_catalog(args.z3_path)
+    return etag_response(catalog.json, catalog.etag)
 
 def learn_transformation():
     request_params = request.get_json()
@@ -94,29 +109,28 @@ def learn_transformation():
     #     return json.dumps({'status': "success", "response": response.json()})
     
         
-    declare_statements = get_declare_statements(exp_folder)
+    with metrics.timer("declare_statements"):
+        declare_statements = get_declare_statements(exp_folder)
     body['declareStatements'] = declare_statements
-    url = os.path.join(PROSEBASEURL, 'transformations', 'learntransformation')
-    response = requests.post(url, json=body)
-    if response.status_code != 200:
-        abort(response.status_code)
+    try:
+        with metrics.timer("prose"):
+            response = prose.learn_transformation(body)
+    except ProseError as e:
+        print(e)
+        abort(e.status_code)
 
-    print("response from prose:", response);
-    print("response from prose:", json.dumps(response.json()))
+    print("response from prose:", json.dumps(response))
 
     #save to database
-    cur = None
-    for possible_t in response.json():
-        hash_val = hashlib.sha256(possible_t["humanReadableAst"].encode('utf-8')).hexdigest()
-        cur = get_db().execute('REPLACE INTO learned_programs(hash, human_readable_ast, xml_ast, comment) VALUES (?,?,?, ?)',(hash_val,
-                                                                                                                             possible_t["humanReadableAst"],
-                                                                                                                             possible_t["xmlAst"],
-                                                                                                                             ""))
-    if cur is not None:
-        get_db().commit()
-        cur.close()
-
-    return json.dumps({'status': "success", "response": response.json()})
+    with transaction() as db:
+        for possible_t in response:
+            hash_val = hashlib.sha256(possible_t["humanReadableAst"].encode('utf-8')).hexdigest()
+            db.execute('REPLACE INTO learned_programs(hash, human_readable_ast, xml_ast, comment) VALUES (?,?,?, ?)',(hash_val,
+                                                                                                                    possible_t["humanReadableAst"],
+                                                                                                                    possible_t["xmlAst"],
+                                                                                                                    ""))
+
+    return json.dumps({'status': "success", "response": response})
 
 # NHAM: will use apply_multi_transformation to simplify dataflow for ExprMap
 # def apply_transformation():
@@ -153,91 +167,120 @@ def apply_multi_transformation():
     exp_name = request_params.get('expName', '')
     lemmas = request_params.get('lemmas', {})
     chosen_program = request_params.get('selectedProgram', '')
+    #lemmas per request to PROSE, default PROSE_CHUNK_SIZE
+    chunk_size = request_params.get('chunkSize', None)
     exp_folder = os.path.join(MEDIA, exp_name)
-    spacer_instance = {"Id": exp_name, "Lemmas": lemmas}
-    declare_statements = get_declare_statements(exp_folder)
-    print(json.dumps(spacer_instance, indent=4)[:200])
+    with metrics.timer("declare_statements"):
+        declare_statements = get_declare_statements(exp_folder)
+    print(json.dumps({"Id": exp_name, "Lemmas": lemmas}, indent=4)[:200])
     body = {
         'declareStatements': declare_statements,
         'program': chosen_program,
-        'spacerInstance': json.dumps(spacer_instance)
     }
     if chosen_program=="to_readable":
-        url = os.path.join(PROSEBASEURL, 'transformations', 'getreadable')
+        path = ('transformations', 'getreadable')
     else:
-        url = os.path.join(PROSEBASEURL, 'transformations', 'applytransformation')
-    response = requests.post(url, json=body)
-    if response.status_code != 200:
-        abort(response.status_code)
-
-    return json.dumps({'status': "success", "response": response.json()})
-
-def get_declare_statements(exp_folder):
-    temp_result = []
-    with open(os.path.join(exp_folder, "var_decls"), "r") as f:
-        for line in f:
-            temp_result.append(line.strip())
-
-    return "\n".join(temp_result)
+        path = ('transformations', 'applytransformation')
+    #only the lemmas whose result is not cached go to PROSE
+    with metrics.timer("prose_cache"):
+        keys = lemma_cache_keys(chosen_program, declare_statements, lemmas)
+        cached = get_cached_results(set(keys.values()))
+    misses = {k: lemmas[k] for k in lemmas if keys[k] not in cached}
+    try:
+        with metrics.timer("prose"):
+            response = prose.apply_transformation(path, body, exp_name, misses, chunk_size) if misses else {}
+            if not isinstance(response, dict) and len(misses) != len(lemmas):
+                #not a map keyed by lemma: it cannot be merged with the cache
+                response = prose.apply_transformation(path, body, exp_name, lemmas, chunk_size)
+    except ProseError as e:
+        print(e)
+        abort(e.status_code)
+
+    if isinstance(response, dict):
+        put_cached_results({keys[k]: response[k] for k in misses if k in response})
+        merged = {}
+        for k in lemmas:
+            if keys[k] in cached:
+                merged[k] = cached[keys[k]]
+            elif k in response:
+                merged[k] = response[k]
+        response = merged
+
+    return json.dumps({'status': "success", 'response': response,
+                       'cache': {'hits': len(lemmas) - len(misses), 'misses': len(misses)}})
 
 def save_exprs(dynamodb=None):
+    """
+    Save the changes to the expr_map of an experiment: changed is a map of
+    the added or changed exprs, removed a list of expr ids. With a version
+    (the one returned by the last save_exprs/get_exprs), nothing is written
+    if the expr_map changed since. expr_map, a whole map as a JSON string,
+    is still accepted and saved as changed.
+    """
     status = "success"
+    version = None
     try:
         request_params = request.get_json()
         exp_name = request_params.get('expName', '')
+        changed = request_params.get('changed', {})
+        removed = request_params.get('removed', [])
+        base_version = request_params.get('version', None)
         expr_map = request_params.get('expr_map', '')
-        expr_map = json.loads(expr_map)
-        exp_folder = os.path.join(MEDIA, exp_name)
-
-        cur = None
-        for k in expr_map:
-            #use replace to insert
-            cur = get_db().execute('REPLACE INTO expr_map(exp_name, expr_id, value) VALUES (?,?,?)',(exp_name,
-                                                                                                     int(k),
-                                                                                                     json.dumps(expr_map[k])))
-        if cur is not None:
-            get_db().commit()
-            cur.close()
+        if expr_map != '':
+            changed = dict(changed, **json.loads(expr_map))
+
+        saved, version = save_expr_map_delta(exp_name, changed, removed, base_version)
+        if not saved:
+            status = "Error: version conflict"
 
     except Exception as e:
         traceback.print_exc()
         status = "Error: {}".format(e)
-    return json.dumps({'status': status})
+    return json.dumps({'status': status, 'version': version})
 
 def get_exprs(): 
     request_params = request.get_json()
     exp_name = request_params.get('expName', '')
+    #only the entries changed since this version
+    since_version = request_params.get('sinceVersion', None)
 
 
     print("exp_name", exp_name)
-    expr_map = get_expr_map(exp_name)
+    version = get_expr_map_version(exp_name)
+    #every save_exprs makes a new version
+    query_key = json.dumps([exp_name, since_version]).encode('utf-8')
+    etag = "exprs-{}-{}".format(version, hashlib.sha1(query_key).hexdigest()[:16])
+    if responses.not_modified(etag):
+        return etag_response(b"", etag)
+    if since_version is None:
+        expr_map = get_expr_map(exp_name)
+        removed = []
+    else:
+        version, expr_map, removed = get_expr_map_since(exp_name, since_version)
 
-    return json.dumps({'status': "success",
-                       'expr_map': expr_map})
+    return etag_response(dumps({'status': "success",
+                                'expr_map': expr_map,
+                                'removed': removed,
+                                'version': version}), etag)
 
-def start_spacer():
-    request_params = request.get_json()
-    file_content = request_params.get('file', '')
-    exp_name = request_params.get('expName', '')
-    new_exp_name = get_new_exp_name(exp_name)
-    print(new_exp_name)
-    insert_db('INSERT INTO exp(exp_name, done, result, aux, time) VALUES (?,?,?,?,?)',(new_exp_name, 0, "UNK", "NA", 0))
+def setup_spacer_exp(new_exp_name, spacer_options, var_names, write_input):
+    """
+    Create the exp row and folder of a Spacer run and return its run_args.
+    write_input(path) puts the input problem at path.
+    """
+    insert_db('INSERT INTO exp(exp_name, done, result, aux, time, state) VALUES (?,?,?,?,?,?)',(new_exp_name, 0, "UNK", "NA", 0, "queued"))
 
-    spacer_user_options = request_params.get("spacerUserOptions", "")
-    var_names = request_params.get("varNames", "")
-    print("var_names", var_names)
     exp_folder = os.path.join(MEDIA, new_exp_name)
     os.mkdir(exp_folder)
 
-    input_file = open(os.path.join(exp_folder, "input_file.smt2"), "wb")
-    input_file.write(str.encode(file_content))
-    input_file.flush() # commit file buffer to disk so that Spacer can access it
+    write_input(os.path.join(exp_folder, "input_file.smt2"))
 
-    stderr_file = open(os.path.join(exp_folder, "stderr"), "w")
-    stdout_file = open(os.path.join(exp_folder, "stdout"), "w")
+    #until the job starts, the experiment shows as running with no output
+    open(os.path.join(exp_folder, "stderr"), "w").close()
+    open(os.path.join(exp_folder, "stdout"), "w").close()
 
     run_args = [args.z3_path]
-    run_args.extend(spacer_user_options.split())
+    run_args.extend(spacer_options)
     run_args.extend(options_for_visualization)
     run_args.append(os.path.abspath(os.path.join(exp_folder, 'input_file.smt2')))
     print(run_args)
@@ -249,10 +292,127 @@ def start_spacer():
     #save VarNames
     with open(os.path.join(exp_folder, "var_names"), "w") as f:
         f.write(var_names)
-        
-    Popen(run_args, stdin=PIPE, stdout=stdout_file, stderr=stderr_file, cwd = exp_folder)
 
-    return json.dumps({'status': "success", 'spacer_state': "running", 'exp_name': new_exp_name})
+    return run_args
+
+def start_spacer():
+    request_params = request.get_json()
+    file_content = request_params.get('file', '')
+    exp_name = request_params.get('expName', '')
+    new_exp_name = get_new_exp_name(exp_name)
+    print(new_exp_name)
+
+    spacer_user_options = request_params.get("spacerUserOptions", "")
+    var_names = request_params.get("varNames", "")
+    print("var_names", var_names)
+
+    #reject bad options before anything is created or spawned
+    errors = get_option_catalog(args.z3_path).check(spacer_user_options.split())
+    if errors:
+        return json.dumps({'status': "Error: invalid options", 'errors': errors})
+
+    def write_input(path):
+        with open(path, "wb") as input_file:
+            input_file.write(str.encode(file_content))
+            input_file.flush() # commit file buffer to disk so that Spacer can access it
+
+    run_args = setup_spacer_exp(new_exp_name, spacer_user_options.split(), var_names, write_input)
+    jobs.submit(new_exp_name, run_args)
+
+    return json.dumps({'status': "success", 'spacer_state': "running", 'job_state': "queued", 'exp_name': new_exp_name})
+
+def expand_option_sets(option_grid, option_sets):
+    """
+    The option lists of the runs of a batch: every combination of the
+    values of option_grid ({name: [values]}), plus each of option_sets
+    (a {name: value} or an option string).
+    """
+    def _to_token(name, value):
+        if isinstance(value, bool):
+            value = "true" if value else "false"
+        return "{}={}".format(name, value)
+
+    configs = []
+    if option_grid:
+        names = sorted(option_grid)
+        for values in itertools.product(*[option_grid[name] for name in names]):
+            configs.append([_to_token(name, value) for name, value in zip(names, values)])
+    for option_set in option_sets or []:
+        if isinstance(option_set, dict):
+            configs.append([_to_token(name, option_set[name]) for name in sorted(option_set)])
+        else:
+            configs.append(option_set.split())
+    return configs
+
+def start_batch():
+    """
+    Start one run of the same input per option set. The input is stored
+    once and shared by the runs, which are scheduled by the job manager.
+    """
+    request_params = request.get_json()
+    file_content = request_params.get('file', '')
+    exp_name = request_params.get('expName', '')
+    base_options = request_params.get("spacerUserOptions", "").split()
+    var_names = request_params.get("varNames", "")
+    configs = expand_option_sets(request_params.get('optionGrid', {}), request_params.get('optionSets', []))
+    if len(configs) == 0:
+        return json.dumps({'status': "Error: no option set given"})
+
+    #check everything before starting anything
+    catalog = get_option_catalog(args.z3_path)
+    errors = []
+    for config in configs:
+        errors.extend(catalog.check(base_options + config))
+    if errors:
+        return json.dumps({'status': "Error: invalid options", 'errors': sorted(set(errors))})
+
+    batch_id = get_new_exp_name(exp_name)
+    #the shared input lives outside MEDIA, where no experiment name can reach it
+    batch_folder = os.path.join(BATCHES, batch_id)
+    os.makedirs(batch_folder)
+    shared_input = os.path.join(batch_folder, "input_file.smt2")
+    with open(shared_input, "wb") as input_file:
+        input_file.write(str.encode(file_content))
+
+    def write_input(path):
+        try:
+            os.link(shared_input, path)
+        except OSError:
+            shutil.copyfile(shared_input, path)
+
+    exp_names = []
+    for i, config in enumerate(configs):
+        new_exp_name = "{}_{}".format(batch_id, i)
+        run_args = setup_spacer_exp(new_exp_name, base_options + config, var_names, write_input)
+        insert_db('INSERT INTO batch(batch_id, exp_name, options) VALUES (?,?,?)', (batch_id, new_exp_name, " ".join(config)))
+        jobs.submit(new_exp_name, run_args)
+        exp_names.append(new_exp_name)
+
+    return json.dumps({'status': "success", 'batch_id': batch_id, 'exp_names': exp_names})
+
+def fetch_batch():
+    #result and runtime of each configuration of a batch
+    request_params = request.get_json()
+    batch_id = request_params.get('batchId', '')
+    runs = []
+    for row in query_db('SELECT batch.exp_name, batch.options, exp.state, exp.done, exp.result, exp.time FROM batch JOIN exp ON batch.exp_name = exp.exp_name WHERE batch.batch_id = ? ORDER BY batch.rowid', (batch_id,)):
+        r = {}
+        for k in row.keys():
+            r[k] = row[k]
+        runs.append(r)
+
+    results = {}
+    for r in runs:
+        results[r['result']] = results.get(r['result'], 0) + 1
+    solved = [r for r in runs if r['result'] in ("sat", "unsat")]
+    fastest = min(solved, key=lambda r: r['time'])['exp_name'] if solved else None
+    return json.dumps({'status': "success",
+                       'batch_id': batch_id,
+                       'runs': runs,
+                       'summary': {'total': len(runs),
+                                   'done': sum(1 for r in runs if r['done']),
+                                   'results': results,
+                                   'fastest': fastest}})
 
 def upload_files():
     def _write_file(exp_folder, content, name):
@@ -270,7 +430,7 @@ def upload_files():
     run_cmd = request_params.get('runCmd', '')
     exp_name = request_params.get('expName', '')
     new_exp_name = get_new_exp_name(exp_name)
-    insert_db('INSERT INTO exp(exp_name, done, result, aux, time) VALUES (?,?,?,?,?)',(new_exp_name, False, "UNK", "NA", 0))
+    insert_db('INSERT INTO exp(exp_name, done, result, aux, time, state) VALUES (?,?,?,?,?,?)',(new_exp_name, False, "UNK", "NA", 0, "uploaded"))
     exp_folder = os.path.join(MEDIA, new_exp_name)
     os.mkdir(exp_folder)
 
@@ -282,23 +442,332 @@ def upload_files():
 
     return json.dumps({'status': "success", 'message': "success"})
 
+def upload_error(e):
+    res = {'status': "Error: {}".format(e), 'received': e.received}
+    return Response(json.dumps(res), status=e.status_code, mimetype="application/json")
+
+def upload_start():
+    #resumable upload of an experiment, see utils/uploads.py
+    try:
+        upload_id = uploads.start_upload(request.get_json())
+    except uploads.UploadError as e:
+        return upload_error(e)
+    return json.dumps({'status': "success", 'upload_id': upload_id})
+
+def upload_chunk():
+    #the body is streamed to the part file, the parameters are in the query string
+    upload_id = request.args.get('uploadId', '')
+    name = request.args.get('file', '')
+    try:
+        offset = int(request.args.get('offset', 0))
+        received = uploads.append_chunk(upload_id, name, offset, request.stream)
+    except ValueError:
+        return upload_error(uploads.UploadError(400, "bad offset"))
+    except uploads.UploadError as e:
+        return upload_error(e)
+    return json.dumps({'status': "success", 'received': received})
+
+def upload_status():
+    request_params = request.get_json()
+    try:
+        files = uploads.upload_status(request_params.get('uploadId', ''))
+    except uploads.UploadError as e:
+        return upload_error(e)
+    return json.dumps({'status': "success", 'files': files})
+
+def upload_finish():
+    request_params = request.get_json()
+    upload_id = request_params.get('uploadId', '')
+    try:
+        _, session = uploads.load_session(upload_id)
+        new_exp_name = get_new_exp_name(session['exp_name'])
+        uploads.finish_upload(upload_id, new_exp_name)
+    except uploads.UploadError as e:
+        return upload_error(e)
+    insert_db('INSERT INTO exp(exp_name, done, result, aux, time, state) VALUES (?,?,?,?,?,?)',(new_exp_name, False, "UNK", "NA", 0, "uploaded"))
+    #parsed in the background, the first poke finds it parsed or joins the parse
+    parse_pool.submit(new_exp_name)
+    return json.dumps({'status': "success", 'exp_name': new_exp_name})
+
+def wait_for_parse(exp_name, retry = False):
+    """
+    Parse a finished experiment in a worker, shared with the other requests
+    for it. None once it is stored, else the response asking to retry later
+    or the error of the parse. A failed parse is only started again once
+    spacer.log changes, or if retry.
+    """
+    return wait_for(exp_name, parse_pool.submit(exp_name, retry))
+
+def wait_for(exp_name, future):
+    #the response of wait_for_parse, for the future of the parse of the experiment
+    try:
+        future.result(timeout=PARSE_WAIT)
+    except concurrent.futures.TimeoutError:
+        res = {'status': "parsing", 'progress': read_progress(exp_name), 'retry_after': PARSE_WAIT}
+        return Response(json.dumps(res), status=202, mimetype="application/json",
+                        headers={'Retry-After': str(max(1, int(PARSE_WAIT)))})
+    except Exception as e:
+        traceback.print_exc()
+        return json.dumps({'status': "Error in parsing: {}".format(e)})
+    return None
+
+def not_parsed_yet(exp_name):
+    #parsed, but not stored (the db write failed, or it was deleted meanwhile)
+    return json.dumps({'status': "Error: {} is not parsed yet".format(exp_name)})
+
+def fetch_summary():
+    #aggregates of the nodes (see ExpSummary), a few KB whatever the size of the tree
+    request_params = request.get_json()
+    exp_name = request_params.get('expName', '')
+    spacer_state = get_exp_state(exp_name)
+    if spacer_state == "running" or ms.has_tail_parser(exp_name):
+        parser = ms.get_tail_parser(exp_name, os.path.join(MEDIA, exp_name, "spacer.log"))
+        with parser.lock:
+            parser.update()
+            summary = parser.summary.to_Json()
+        return json.dumps({'status': "success", 'spacer_state': spacer_state, 'summary': summary})
+    row = query_db("SELECT summary FROM exp_summary WHERE exp_name = ?", (exp_name,), one=True)
+    if row is None:
+        #never parsed, or parsed before the summaries were stored
+        not_parsed = wait_for_parse(exp_name)
+        if not_parsed is not None:
+            return not_parsed
+        row = query_db("SELECT summary FROM exp_summary WHERE exp_name = ?", (exp_name,), one=True)
+        if row is None:
+            return not_parsed_yet(exp_name)
+    return '{"status": "success", "spacer_state": %s, "summary": %s}' % (json.dumps(spacer_state), row["summary"])
+
+def stored_poke(exp_name, row, interned):
+    """
+    The poke result of a stored experiment, which does not change until it
+    is parsed again (a new nodes_list row), served from its serialization
+    kept gzipped in the exp folder, see responses.
+    """
+    key = "{}\0{}\0{}".format(exp_name, row['rowid'], row['nodes_list']).encode('utf-8')
+    digest = hashlib.sha1(key).hexdigest()[:20]
+    tag = digest + ("-interned" if interned else "")
+    if not os.path.isdir(os.path.join(MEDIA, exp_name)):
+        #nowhere to keep it
+        return Response(stream_with_context(iter_parsed_exp(exp_name, row['nodes_list'], interned)), mimetype="application/json")
+    cache_path = poke_cache_path(exp_name, tag)
+    if not os.path.exists(cache_path):
+        #the ones of the previous parses, the other variant (interned or not) of this one is kept
+        remove_poke_caches(exp_name, keep=digest)
+    return responses.cached_response(cache_path, "poke-" + tag,
+                                     lambda: iter_parsed_exp(exp_name, row['nodes_list'], interned))
+
 def poke():
     #TODO: finish parsing using all the files in the exp_folder (input_file, etc.)
     request_params = request.get_json()
     exp_name = request_params.get('expName', '')
+    #cursor returned as next_node by the previous poke, to only get the new nodes
+    from_node = request_params.get('fromNode', None)
+    #nodes with an exprRef into exprs instead of their expr, see parse_exp
+    interned = request_params.get('internExprs', INTERN_EXPRS)
+    #parse again a finished experiment whose parse failed
+    retry = request_params.get('retryParse', False)
 
     #check if it is already in the db
-    in_db = query_db("SELECT * FROM nodes_list WHERE exp_name = ?", (exp_name,))
+    in_db = query_db("SELECT rowid, * FROM nodes_list WHERE exp_name = ?", (exp_name,))
+    spacer_state = get_exp_state(exp_name)
 
     if in_db:
         assert(len(in_db) == 1)
-        res = json.loads(in_db[0]['nodes_list'])
+        return stored_poke(exp_name, in_db[0], interned)
+    elif spacer_state == "running":
+        #incremental, only what was appended since the last poke is parsed
+        res_json = ms.parse_exp(exp_name, from_node, interned=interned, spacer_state=spacer_state)
+    elif ms.has_tail_parser(exp_name):
+        #it finished: its tail parser is finished and stored here, the other requests for it wait on this parse
+        future, ran_here = parse_pool.run_here(exp_name, lambda: ms.parse_exp(exp_name, from_node, interned=interned,
+                                                                               spacer_state=spacer_state))
+        if not ran_here:
+            not_parsed = wait_for(exp_name, future)
+            if not_parsed is not None:
+                return not_parsed
+            in_db = query_db("SELECT rowid, * FROM nodes_list WHERE exp_name = ?", (exp_name,), one=True)
+            if in_db is None:
+                return not_parsed_yet(exp_name)
+            return stored_poke(exp_name, in_db, interned)
+        res_json = future.result()
+        if has_nodes(exp_name):
+            threading.Thread(target=compress_stored, args=(exp_name,), daemon=True).start()
     else:
-        res = ms.parse_exp(exp_name)
+        #finished and never parsed
+        not_parsed = wait_for_parse(exp_name, retry)
+        if not_parsed is not None:
+            return not_parsed
+        in_db = query_db("SELECT rowid, * FROM nodes_list WHERE exp_name = ?", (exp_name,), one=True)
+        if in_db is None:
+            return not_parsed_yet(exp_name)
+        return stored_poke(exp_name, in_db, interned)
+
+
+    return Response(stream_with_context(res_json), mimetype="application/json")
+
+def stream_exp():
+    #EventSource only does GET, the parameters are in the query string
+    exp_name = request.args.get('expName', '')
+    #a reconnecting EventSource sends the id of the last event it got
+    from_node = request.headers.get('Last-Event-ID', request.args.get('fromNode', 0))
+    try:
+        from_node = int(from_node)
+    except ValueError:
+        from_node = 0
+    return Response(stream_with_context(live.events(exp_name, from_node)), mimetype="text/event-stream",
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+def fetch_subtree():
+    #the nodes under nodeID (included), up to depth levels below it
+    request_params = request.get_json()
+    exp_name = request_params.get('expName', '')
+    node_id = request_params.get('nodeID', 0)
+    depth = request_params.get('depth', -1)
+    if not has_nodes(exp_name):
+        #not stored (yet), nothing to keep for the next pages
+        return fetch_nodes_page_by_id(exp_name, [], -1, request_params.get('pageSize'))
+    #the sorted ids of the subtree are kept, a page resumes from afterNode in them
+    with metrics.timer("subtree"):
+        node_ids = lod.stored_subtree(exp_name, node_id, None if depth < 0 else depth,
+                                      lambda: load_parents(exp_name))
+    return fetch_nodes_page_by_id(exp_name, node_ids, request_params.get('afterNode', -1), request_params.get('pageSize'))
+
+#search criteria: request parameter -> column of nodes (ptName also matches the pt_name of lemmas, see Event)
+search_columns = {'exprID': 'expr_id', 'pobID': 'pob_id', 'ptName': 'search_pt_name', 'eventType': 'event_type', 'level': 'level'}
+
+def search_nodes():
+    """
+    The nodeIDs of the nodes with the given exprID, pobID, ptName, eventType
+    and level, whose expr has all the tokens (symbols, e.g. variable names),
+    paged like fetch_level with afterNode and pageSize.
+    """
+    request_params = request.get_json()
+    exp_name = request_params.get('expName', '')
+    criteria = {column: request_params[param] for param, column in search_columns.items()
+                if request_params.get(param) is not None}
+    tokens = request_params.get('tokens', [])
+    if isinstance(tokens, str):
+        tokens = tokens.split()
+    after_node = request_params.get('afterNode', -1)
+    page_size = nodes_page_size(request_params.get('pageSize'))
+
+    if get_exp_state(exp_name) == "running" or ms.has_tail_parser(exp_name):
+        #not stored yet, scan the events of the tail parser
+        parser = ms.get_tail_parser(exp_name, os.path.join(MEDIA, exp_name, "spacer.log"))
+        with parser.lock:
+            parser.update()
+            node_ids = list(itertools.islice(parser.search(criteria, tokens, after_node), page_size))
+        next_node = node_ids[-1] if len(node_ids) == page_size else None
+        return json.dumps({'status': "success", 'node_ids': node_ids, 'next_node': next_node})
+    if not has_nodes(exp_name):
+        not_parsed = wait_for_parse(exp_name)
+        if not_parsed is not None:
+            return not_parsed
+    if tokens:
+        ms.index_stored_nodes(exp_name)
+    return search_stored_nodes(exp_name, criteria, tokens, after_node, page_size)
+
+def fetch_lemma_asts():
+    """
+    The ASTs of the lemmas of an experiment (or only of those in exprIDs),
+    as one DAG keyed by exprID, see lemma_ast.
+    """
+    request_params = request.get_json()
+    exp_name = request_params.get('expName', '')
+    expr_ids = request_params.get('exprIDs', None)
+    if expr_ids is not None:
+        expr_ids = set(str(expr_id) for expr_id in expr_ids)
+    exp_folder = os.path.join(MEDIA, exp_name)
 
+    lemmas = {}
+    if get_exp_state(exp_name) == "running" or ms.has_tail_parser(exp_name):
+        parser = ms.get_tail_parser(exp_name, os.path.join(exp_folder, "spacer.log"))
+        with parser.lock:
+            parser.update()
+            with parser.open_log() as log:
+                for event in parser.all_events:
+                    if event.event_type == ms.EType.ADD_LEM and (expr_ids is None or str(event.exprID) in expr_ids):
+                        lemmas[str(event.exprID)] = parser.read_expr(event, log)
+    else:
+        if not has_nodes(exp_name):
+            not_parsed = wait_for_parse(exp_name)
+            if not_parsed is not None:
+                return not_parsed
+        for row in query_db("SELECT expr_id, expr FROM nodes_with_exprs WHERE exp_name = ? AND event_type = ? ORDER BY node_id",
+                            (exp_name, str(ms.EType.ADD_LEM))):
+            if expr_ids is None or str(row["expr_id"]) in expr_ids:
+                lemmas[str(row["expr_id"])] = row["expr"]
 
+    try:
+        with metrics.timer("declare_statements"):
+            declare_statements = get_declare_statements(exp_folder)
+    except OSError as e:
+        return json.dumps({'status': "Error: no declarations for {}: {}".format(exp_name, e)})
+    with metrics.timer("lemma_ast"):
+        res = lemma_ast.lemma_asts(declare_statements, lemmas)
+    res['status'] = "success"
     return json.dumps(res)
 
+def fetch_level():
+    request_params = request.get_json()
+    exp_name = request_params.get('expName', '')
+    level = request_params.get('level', 0)
+    return fetch_nodes_page('SELECT * FROM nodes_with_exprs WHERE exp_name = ? AND level = ? AND node_id', (exp_name, level),
+                            request_params.get('afterNode', -1), request_params.get('pageSize'))
+
+def fetch_range():
+    #the nodes with start <= nodeID < end
+    request_params = request.get_json()
+    exp_name = request_params.get('expName', '')
+    start = request_params.get('start', 0)
+    end = request_params.get('end', sys.maxsize)
+    return fetch_nodes_page('SELECT * FROM nodes_with_exprs WHERE exp_name = ? AND node_id < ? AND node_id', (exp_name, end),
+                            request_params.get('afterNode', start - 1), request_params.get('pageSize'))
+
+def fetch_lod():
+    """
+    A tree of at most budget nodes, see lod: the subtree of rootID, the
+    parts that do not fit folded into count nodes, nothing more than
+    maxDepth levels below rootID. total is the size of the whole subtree.
+    """
+    request_params = request.get_json()
+    exp_name = request_params.get('expName', '')
+    root = request_params.get('rootID', 0)
+    budget = lod_budget(request_params.get('budget'))
+    max_depth = request_params.get('maxDepth', None)
+    spacer_state = get_exp_state(exp_name)
+
+    if spacer_state == "running" or ms.has_tail_parser(exp_name):
+        parser = ms.get_tail_parser(exp_name, os.path.join(MEDIA, exp_name, "spacer.log"))
+        with parser.lock:
+            parser.update()
+            events = parser.all_events
+            if not 0 <= root < len(events):
+                return json.dumps({'status': "Error: no node {}".format(root)})
+            children = [event.children for event in events]
+            sizes = lod.subtree_sizes([event.parent for event in events])
+            kept, folded = lod.decimate(children, sizes, root, budget, max_depth)
+            #in log order, a compressed log is only read forward
+            with parser.open_log() as log:
+                nodes = [events[idx].to_Json(parser.read_expr(events[idx], log)) for idx in sorted(kept)]
+    else:
+        if not has_nodes(exp_name):
+            not_parsed = wait_for_parse(exp_name)
+            if not_parsed is not None:
+                return not_parsed
+        with metrics.timer("lod_tree"):
+            children, sizes = lod.stored_tree(exp_name, lambda: load_parents(exp_name))
+        if not 0 <= root < len(sizes):
+            return json.dumps({'status': "Error: no node {}".format(root)})
+        kept, folded = lod.decimate(children, sizes, root, budget, max_depth)
+        nodes = fetch_stored_nodes(exp_name, kept)
+
+    return json.dumps({'status': "success",
+                       'spacer_state': spacer_state,
+                       'root': root,
+                       'total': sizes[root],
+                       'nodes_list': lod.lod_nodes(nodes, kept, folded, sizes)})
+
 
 
 @app.route('/spacer/fetch_exps', methods=['POST'])
@@ -313,9 +782,42 @@ def handle_fetch_options():
 @app.route('/spacer/start_iterative', methods=['POST'])
 def handle_start_spacer_iterative():
     return start_spacer()
+@app.route('/spacer/start_batch', methods=['POST'])
+def handle_start_batch():
+    return start_batch()
+@app.route('/spacer/fetch_batch', methods=['POST'])
+def handle_fetch_batch():
+    return fetch_batch()
 @app.route('/spacer/poke', methods=['POST'])
 def handle_poke():
     return poke()
+@app.route('/spacer/summary', methods=['POST'])
+def handle_fetch_summary():
+    return fetch_summary()
+@app.route('/spacer/metrics', methods=['GET'])
+def handle_metrics():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+@app.route('/spacer/stream', methods=['GET'])
+def handle_stream_exp():
+    return stream_exp()
+@app.route('/spacer/fetch_subtree', methods=['POST'])
+def handle_fetch_subtree():
+    return fetch_subtree()
+@app.route('/spacer/search', methods=['POST'])
+def handle_search_nodes():
+    return search_nodes()
+@app.route('/spacer/lemma_asts', methods=['POST'])
+def handle_fetch_lemma_asts():
+    return fetch_lemma_asts()
+@app.route('/spacer/fetch_level', methods=['POST'])
+def handle_fetch_level():
+    return fetch_level()
+@app.route('/spacer/fetch_range', methods=['POST'])
+def handle_fetch_range():
+    return fetch_range()
+@app.route('/spacer/lod', methods=['POST'])
+def handle_fetch_lod():
+    return fetch_lod()
 @app.route('/spacer/save_exprs', methods=['POST'])
 def handle_save():
     return save_exprs()
@@ -337,5 +839,17 @@ def handle_apply_multi_transform():
 @app.route('/spacer/upload_files', methods=['POST'])
 def handle_upload_files():
     return upload_files()
+@app.route('/spacer/upload_start', methods=['POST'])
+def handle_upload_start():
+    return upload_start()
+@app.route('/spacer/upload_chunk', methods=['POST'])
+def handle_upload_chunk():
+    return upload_chunk()
+@app.route('/spacer/upload_status', methods=['POST'])
+def handle_upload_status():
+    return upload_status()
+@app.route('/spacer/upload_finish', methods=['POST'])
+def handle_upload_finish():
+    return upload_finish()
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000)
@@ -3,12 +3,76 @@ if os.environ.get('BACKEND_DATA_PATH') is not None:
     BACKEND_DATA_PATH = os.environ['BACKEND_DATA_PATH']
     DATABASE = os.path.join(BACKEND_DATA_PATH, 'exp_db')
     MEDIA = os.path.join(BACKEND_DATA_PATH, 'media')
+    DECLS_CACHE = os.path.join(BACKEND_DATA_PATH, 'decls_cache')
+    OPTIONS_CACHE = os.path.join(BACKEND_DATA_PATH, 'options_cache')
+    UPLOADS = os.path.join(BACKEND_DATA_PATH, 'uploads')
+    BATCHES = os.path.join(BACKEND_DATA_PATH, 'batches')
 else:
     BACKEND_DATA_PATH = None
     DATABASE = os.path.abspath('./exp_db')
     MEDIA = os.path.abspath('./media')
+    DECLS_CACHE = os.path.abspath('./decls_cache')
+    OPTIONS_CACHE = os.path.abspath('./options_cache')
+    UPLOADS = os.path.abspath('./uploads')
+    BATCHES = os.path.abspath('./batches')
 
-PROSEBASEURL = 'http://SpacerProseBackend:2000/api/v1/'
+PROSEBASEURL = os.environ.get('PROSE_BASE_URL', 'http://SpacerProseBackend:2000/api/v1/')
+#PROSE client: timeout (s), retries, pooled connections, and lemmas per chunk (0 for no chunking)
+PROSE_TIMEOUT = float(os.environ.get('PROSE_TIMEOUT', 300))
+PROSE_RETRIES = int(os.environ.get('PROSE_RETRIES', 2))
+PROSE_POOL_SIZE = int(os.environ.get('PROSE_POOL_SIZE', 8))
+PROSE_CHUNK_SIZE = int(os.environ.get('PROSE_CHUNK_SIZE', 0))
+#results of programs on lemmas kept in prose_cache
+PROSE_CACHE_SIZE = int(os.environ.get('PROSE_CACHE_SIZE', 100000))
+
+#Spacer jobs: how many run at once, wall-clock limit (s) and memory limit (MB), 0 for none
+MAX_SPACER_JOBS = int(os.environ.get('MAX_SPACER_JOBS', os.cpu_count() or 1))
+SPACER_TIMEOUT = int(os.environ.get('SPACER_TIMEOUT', 0))
+SPACER_MEMORY_LIMIT = int(os.environ.get('SPACER_MEMORY_LIMIT', 0))
+
+#number of var_decls kept in memory, the others are read back from DECLS_CACHE
+DECLS_CACHE_SIZE = 128
+
+#paging of the fetch_subtree, fetch_level and fetch_range endpoints
+NODES_PAGE_SIZE = 1000
+MAX_NODES_PAGE_SIZE = 10000
+#/spacer/lod: nodes in a decimated tree, by default and at most
+LOD_BUDGET = 2000
+MAX_LOD_BUDGET = 20000
+#shapes of stored trees kept in memory for it
+LOD_TREES = 8
+#parsers of running experiments kept in memory, the least recently used ones are dropped (and read the log again if needed)
+TAIL_PARSERS = int(os.environ.get('TAIL_PARSERS', 32))
+#worker processes parsing finished experiments, and how long (s) poke waits on a parse before asking to retry
+PARSE_WORKERS = int(os.environ.get('PARSE_WORKERS', 2))
+PARSE_WAIT = 1.0
+
+#send the phases timed during each request in a Server-Timing header
+TIMING_HEADER = os.environ.get('TIMING_HEADER', '') == '1'
+
+#resumable uploads (utils/uploads.py) not finished after this many seconds are removed
+UPLOAD_EXPIRY = 24 * 3600
+
+#how spacer.log and stderr of the experiments are compressed once parsed: gzip, zstd (needs zstandard) or identity (not at all)
+ARTIFACT_ENCODING = os.environ.get('ARTIFACT_ENCODING', 'gzip')
+
+#responses smaller than this (bytes) are sent uncompressed, whatever the Accept-Encoding of the client
+COMPRESS_MIN_SIZE = 1024
+
+#default of internExprs in poke: the nodes refer to their exprs, sent once, instead of repeating them
+INTERN_EXPRS = os.environ.get('INTERN_EXPRS', '') == '1'
+
+#/spacer/stream: seconds between two reads of spacer.log and between keepalives, events queued per subscriber
+STREAM_POLL_INTERVAL = float(os.environ.get('STREAM_POLL_INTERVAL', 0.5))
+STREAM_KEEPALIVE = 15
+STREAM_QUEUE_SIZE = 256
+
+#largest page of fetch_exps, it returns every experiment when no pageSize is given
+MAX_EXPS_PAGE_SIZE = 1000
+
+#/spacer/lemma_asts: converted lemmas kept in memory, and pysmt environments (one per set of declarations)
+LEMMA_AST_CACHE_SIZE = 100000
+LEMMA_AST_PARSERS = 16
 
 print('DATABASE=', DATABASE)
 print('MEDIA=', MEDIA)
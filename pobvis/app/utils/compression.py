@@ -0,0 +1,164 @@
+"""
+Compressed files: gzip always, zstd when the zstandard package is
+installed (it is optional, like resource in jobs).
+
+The artifacts of a finished experiment (spacer.log and stderr, see
+ARTIFACTS) are kept compressed once it is parsed, as spacer.log.gz (or
+.zst with ARTIFACT_ENCODING=zstd). open_artifact opens whichever form is
+there and decompresses as it reads, so the readers (safe_read, the trace
+parser) do not care and no decompressed copy is written.
+"""
+import io
+import os
+import gzip
+import shutil
+import threading
+from app.settings import ARTIFACT_ENCODING
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ENCODINGS = ("identity", "gzip", "zstd")
+SUFFIXES = {"gzip": ".gz", "zstd": ".zst"}
+#the files of an experiment folder worth compressing, the others are small or read by chctools (input_file.smt2)
+ARTIFACTS = ("spacer.log", "stderr")
+COPY_BUFFER = 1 << 20
+#the level of gzip itself (9) is several times slower for little gain on traces
+GZIP_LEVEL = 6
+
+#compressions in this process run one at a time, so that two of the same file do not race
+_compress_lock = threading.Lock()
+
+def check_encoding(encoding):
+    if encoding not in ENCODINGS:
+        raise ValueError("unknown encoding {}, expected one of {}".format(encoding, ", ".join(ENCODINGS)))
+    if encoding == "zstd" and zstandard is None:
+        raise ValueError("zstd needs the zstandard package")
+
+class _ZstdReader(object):
+    """
+    A binary file reading the decompressed content of the open file raw,
+    seekable like a gzip file: forward by decompressing up to the offset,
+    backward by starting over from the beginning of raw.
+    """
+    def __init__(self, raw, close_raw):
+        self.raw = raw
+        self.close_raw = close_raw
+        self._start()
+
+    def _start(self):
+        #buffered for readline
+        self.f = io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(self.raw, closefd=False))
+        self.pos = 0
+
+    def read(self, size = -1):
+        data = self.f.read(size)
+        self.pos += len(data)
+        return data
+
+    def readline(self, size = -1):
+        line = self.f.readline(size)
+        self.pos += len(line)
+        return line
+
+    def __iter__(self):
+        return iter(self.readline, b"")
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence = io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence != io.SEEK_SET:
+            raise io.UnsupportedOperation("cannot seek from the end of a zstd stream")
+        if offset < self.pos:
+            self.raw.seek(0)
+            self._start()
+        while self.pos < offset and self.read(min(COPY_BUFFER, offset - self.pos)):
+            pass
+        return self.pos
+
+    def close(self):
+        self.f.close()
+        if self.close_raw:
+            self.raw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def open_decoded(path, encoding):
+    #a binary file reading the decompressed content of path, decompressed as it is read
+    check_encoding(encoding)
+    if encoding == "gzip":
+        return gzip.open(path, "rb")
+    f = open(path, "rb")
+    if encoding == "zstd":
+        return _ZstdReader(f, True)
+    return f
+
+def decoding(raw, encoding):
+    #a binary file reading the decompressed content of the open file raw, which it leaves open
+    check_encoding(encoding)
+    if encoding == "gzip":
+        return gzip.GzipFile(fileobj=raw, mode="rb")
+    if encoding == "zstd":
+        return _ZstdReader(raw, False)
+    return raw
+
+def find_artifact(path):
+    """(path of the stored form, encoding) of the file at path, None if there is none"""
+    if os.path.exists(path):
+        return path, "identity"
+    for encoding, suffix in SUFFIXES.items():
+        if os.path.exists(path + suffix):
+            return path + suffix, encoding
+    return None
+
+def open_artifact(path, text = False):
+    """Open the file at path, compressed or not, for reading"""
+    found = find_artifact(path)
+    if found is None:
+        raise FileNotFoundError("no such file: {}".format(path))
+    stored_path, encoding = found
+    if text and encoding == "zstd":
+        #read through, no need to seek
+        return io.TextIOWrapper(io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(stored_path, "rb"), closefd=True)))
+    f = open_decoded(stored_path, encoding)
+    return io.TextIOWrapper(f) if text else f
+
+def compress_artifact(path, encoding = ARTIFACT_ENCODING):
+    """Replace the file at path by its compressed form, return the path of that"""
+    check_encoding(encoding)
+    if encoding == "identity" or not os.path.exists(path):
+        return path
+    compressed_path = path + SUFFIXES[encoding]
+    tmp_path = "{}.{}.tmp".format(compressed_path, os.getpid())
+    with open(path, "rb") as src:
+        if encoding == "gzip":
+            dst = gzip.open(tmp_path, "wb", compresslevel=GZIP_LEVEL)
+        else:
+            dst = zstandard.ZstdCompressor().stream_writer(open(tmp_path, "wb"), closefd=True)
+        with dst:
+            shutil.copyfileobj(src, dst, COPY_BUFFER)
+    os.replace(tmp_path, compressed_path)
+    #a reader that has the file open keeps reading it
+    os.remove(path)
+    return compressed_path
+
+def compress_exp(exp_folder, encoding = ARTIFACT_ENCODING):
+    #compress the ARTIFACTS of a finished experiment
+    with _compress_lock:
+        for name in ARTIFACTS:
+            compress_artifact(os.path.join(exp_folder, name), encoding)
+
+if __name__ == '__main__':
+    #python3 -m app.utils.compression media/exp1 media/exp2 ..., for experiments parsed before this was done on parse
+    import sys
+    for exp_folder in sys.argv[1:]:
+        compress_exp(exp_folder)
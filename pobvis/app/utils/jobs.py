@@ -0,0 +1,176 @@
+"""
+Runs the Spacer processes of the experiments.
+
+Submitted experiments are queued and at most MAX_SPACER_JOBS of them run at
+once, each under a wall-clock and a memory limit. The state of each job is
+kept in the exp table (state, pid, started, exit_code, and done, result,
+time once it is over), so that it can be picked up again after a restart.
+
+job states: queued -> running -> done | timeout | error
+uploaded experiments have no job, their state is uploaded
+"""
+import os
+import json
+import time
+import queue
+import threading
+import traceback
+from subprocess import PIPE, Popen, TimeoutExpired
+import psutil
+from app.utils.storage import get_db, transaction
+from app.settings import MEDIA, MAX_SPACER_JOBS, SPACER_TIMEOUT, SPACER_MEMORY_LIMIT
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+accepted_results = ["sat", "unsat", "unknown"]
+
+def _update_exp(exp_name, **columns):
+    assignments = ", ".join("{} = ?".format(k) for k in columns)
+    with transaction() as db:
+        db.execute("UPDATE exp SET {} WHERE exp_name = ?".format(assignments),
+                   tuple(columns.values()) + (exp_name,))
+
+def _read_result(exp_folder):
+    try:
+        with open(os.path.join(exp_folder, "stdout"), "r") as f:
+            first_line = f.readline().strip()
+    except OSError:
+        return "UNK"
+    return first_line if first_line in accepted_results else "UNK"
+
+def _limit_memory():
+    #runs in the child, before exec
+    if resource is not None and SPACER_MEMORY_LIMIT:
+        limit = SPACER_MEMORY_LIMIT * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+class JobManager(object):
+    def __init__(self, max_jobs = MAX_SPACER_JOBS, timeout = SPACER_TIMEOUT):
+        self.timeout = timeout or None
+        self.slots = threading.BoundedSemaphore(max_jobs)
+        self.queue = queue.Queue()
+        self.running = {}
+        self.running_lock = threading.Lock()
+        self.dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+        self.dispatcher.start()
+
+    def submit(self, exp_name, run_args):
+        """Queue a Spacer run, the exp row and exp folder must already exist"""
+        exp_folder = os.path.join(MEDIA, exp_name)
+        #kept so that the job can be queued again after a restart
+        with open(os.path.join(exp_folder, "run_args"), "w") as f:
+            json.dump(run_args, f)
+        _update_exp(exp_name, state="queued")
+        self.queue.put((exp_name, run_args))
+
+    def running_count(self):
+        with self.running_lock:
+            return len(self.running)
+
+    def is_running(self, exp_name):
+        with self.running_lock:
+            return exp_name in self.running
+
+    def _dispatch(self):
+        while True:
+            exp_name, run_args = self.queue.get()
+            self.slots.acquire()
+            threading.Thread(target=self._run, args=(exp_name, run_args), daemon=True).start()
+
+    def _run(self, exp_name, run_args):
+        try:
+            exp_folder = os.path.join(MEDIA, exp_name)
+            if not os.path.isdir(exp_folder):
+                #deleted while it was queued, delete_exp removes the folders of the jobs not running yet
+                print("job", exp_name, "deleted")
+                return
+            with open(os.path.join(exp_folder, "stdout"), "w") as stdout_file, \
+                 open(os.path.join(exp_folder, "stderr"), "w") as stderr_file:
+                started = time.time()
+                proc = Popen(run_args, stdin=PIPE, stdout=stdout_file, stderr=stderr_file,
+                             cwd=exp_folder, preexec_fn=_limit_memory if resource is not None else None)
+                _update_exp(exp_name, state="running", pid=proc.pid, started=started)
+                with self.running_lock:
+                    self.running[exp_name] = proc.pid
+                try:
+                    exit_code = proc.wait(timeout=self.timeout)
+                    state = "done" if exit_code == 0 else "error"
+                except TimeoutExpired:
+                    proc.kill()
+                    exit_code = proc.wait()
+                    state = "timeout"
+            self._finish(exp_name, state, exit_code, started)
+        except Exception:
+            traceback.print_exc()
+            _update_exp(exp_name, state="error", done=1)
+        finally:
+            with self.running_lock:
+                self.running.pop(exp_name, None)
+            self.slots.release()
+
+    def _watch(self, exp_name, proc, started, holds_slot):
+        #follow a process started before the restart, it is not our child
+        try:
+            with self.running_lock:
+                self.running[exp_name] = proc.pid
+            timeout = None
+            if self.timeout is not None:
+                timeout = max(0, self.timeout - (time.time() - started))
+            try:
+                proc.wait(timeout=timeout)
+                state = "done"
+            except psutil.TimeoutExpired:
+                proc.kill()
+                state = "timeout"
+            self._finish(exp_name, state, None, started)
+        except psutil.NoSuchProcess:
+            self._finish(exp_name, "done", None, started)
+        except Exception:
+            traceback.print_exc()
+        finally:
+            with self.running_lock:
+                self.running.pop(exp_name, None)
+            if holds_slot:
+                self.slots.release()
+
+    def _finish(self, exp_name, state, exit_code, started):
+        result = _read_result(os.path.join(MEDIA, exp_name))
+        if state == "done" and result == "UNK":
+            state = "error"
+        _update_exp(exp_name, state=state, exit_code=exit_code, done=1, result=result,
+                    time=int(time.time() - started))
+        print("job", exp_name, state, result)
+
+    def recover(self):
+        """
+        Pick up the jobs of a previous server: queued ones are queued again,
+        running ones are followed if their process is still alive.
+        """
+        rows = get_db().execute("SELECT exp_name, state, pid, started FROM exp WHERE done = 0 AND state IN ('queued', 'running')").fetchall()
+        for row in rows:
+            exp_name = row["exp_name"]
+            exp_folder = os.path.join(MEDIA, exp_name)
+            if row["state"] == "queued":
+                try:
+                    with open(os.path.join(exp_folder, "run_args"), "r") as f:
+                        run_args = json.load(f)
+                except (OSError, ValueError):
+                    _update_exp(exp_name, state="error", done=1)
+                    continue
+                self.queue.put((exp_name, run_args))
+                continue
+            started = row["started"] or time.time()
+            try:
+                proc = psutil.Process(row["pid"])
+                alive = exp_folder in " ".join(proc.cmdline())
+            except (psutil.Error, TypeError, ValueError):
+                alive = False
+            if alive:
+                holds_slot = self.slots.acquire(blocking=False)
+                threading.Thread(target=self._watch, args=(exp_name, proc, started, holds_slot), daemon=True).start()
+            else:
+                #it finished (or died) while the server was down
+                self._finish(exp_name, "done", None, started)
@@ -0,0 +1,171 @@
+"""
+The lemmas of an experiment as the JSON ASTs of the frontend, the same as
+order_node(to_json(formula)) in utils, but sent as one DAG for the batch:
+
+    {"nodes": [{"type": "SYMBOL", "content": "x"}, {"type": "INT_CONSTANT", "content": "1"},
+               {"type": "LE", "content": [0, 1]}, ...],
+     "roots": {exprID: index of its AST in nodes}}
+
+The content of a node with arguments is the list of the indices of its
+arguments, which always come before it in nodes. A subterm shared by
+several lemmas (or several times in one) is in nodes once.
+
+Lemmas are parsed with pysmt, in one environment per set of declarations,
+which hash-conses the subterms: each distinct subterm is converted and
+ordered once, iteratively, so deep lemmas do not hit the recursion limit.
+The converted lemmas are kept in an in-process LRU keyed by the text of the
+lemma and the declarations it is parsed with, shared by the experiments on
+the same benchmark.
+"""
+import io
+import re
+import hashlib
+import threading
+from collections import OrderedDict
+from pysmt.environment import Environment
+from pysmt.fnode import FNode
+from pysmt.smtlib.parser import SmtLibParser, Tokenizer
+import pysmt.operators as pyopt
+from app.utils.utils import calculate_val
+from app.settings import LEMMA_AST_CACHE_SIZE, LEMMA_AST_PARSERS
+
+#the operators whose arguments order_node sorts
+COMMUTATIVE = ("PLUS", "TIMES", "AND")
+
+declare_re = re.compile(r"\(declare-const\s+(\S+)\s+\((.*)\)\)$")
+
+#pysmt environments are not thread safe, conversions run one at a time
+_lock = threading.Lock()
+#declarations digest -> SmtLibParser with the symbols declared
+_parsers = OrderedDict()
+#(declarations digest, lemma) -> its AST (see _convert), or the error parsing it
+_asts = OrderedDict()
+
+def _lru_get(lru, key):
+    if key not in lru:
+        return None
+    lru.move_to_end(key)
+    return lru[key]
+
+def _lru_put(lru, key, value, size):
+    lru[key] = value
+    lru.move_to_end(key)
+    while len(lru) > size:
+        lru.popitem(last=False)
+
+def _smtlib_declarations(declare_statements):
+    #var_decls writes (declare-const name (Sort)), which pysmt does not read
+    lines = []
+    for line in declare_statements.splitlines():
+        m = declare_re.match(line.strip())
+        if m is None:
+            continue
+        sort = m.group(2).strip()
+        if " " in sort:
+            sort = "(" + sort + ")"
+        lines.append("(declare-fun {} () {})".format(m.group(1), sort))
+    return "\n".join(lines)
+
+def _get_parser(digest, declare_statements):
+    parser = _lru_get(_parsers, digest)
+    if parser is None:
+        parser = SmtLibParser(environment=Environment())
+        parser.get_script(io.StringIO(_smtlib_declarations(declare_statements)))
+        _lru_put(_parsers, digest, parser, LEMMA_AST_PARSERS)
+    return parser
+
+def _node_type(node):
+    if node.is_real_constant():
+        return "0_REAL_CONSTANT" #same hack as to_json, to put real constants at the end
+    return pyopt.op_to_str(node.node_type())
+
+def _convert(formula):
+    """
+    The AST of formula as a tuple of (type, content), content being the
+    value of a leaf or the tuple of the indices of the arguments; the root
+    is the last one.
+    """
+    index = {}
+    entries = []
+    #str(content) and repr(node) of the nodes in the form order_node returns, for its sort key
+    content_strs = []
+    reprs = []
+    stack = [(formula, False)]
+    while stack:
+        node, expanded = stack.pop()
+        if node in index:
+            continue
+        args = node.args()
+        if args and not expanded:
+            stack.append((node, True))
+            stack.extend((a, False) for a in reversed(args) if a not in index)
+            continue
+        type_str = _node_type(node)
+        if not args:
+            content = calculate_val(node)
+            content_str, content_repr = str(content), repr(content)
+        else:
+            content = [index[a] for a in args]
+            if type_str in COMMUTATIVE:
+                content.sort(key=lambda i: (entries[i][0], content_strs[i]), reverse=True)
+            content = tuple(content)
+            content_str = content_repr = "[" + ", ".join(reprs[i] for i in content) + "]"
+        index[node] = len(entries)
+        entries.append((type_str, content))
+        content_strs.append(content_str)
+        reprs.append("{'type': %r, 'content': %s}" % (type_str, content_repr))
+    return tuple(entries)
+
+class AstDag(object):
+    #the nodes of the ASTs of a batch, each distinct (type, content) once
+    def __init__(self):
+        self.nodes = []
+        self.index = {}
+
+    def add(self, ast):
+        #index of the root of ast (from _convert) in nodes
+        ids = []
+        for type_str, content in ast:
+            if isinstance(content, tuple):
+                content = tuple(ids[i] for i in content)
+            key = (type_str, content)
+            idx = self.index.get(key)
+            if idx is None:
+                idx = self.index[key] = len(self.nodes)
+                self.nodes.append({"type": type_str, "content": list(content) if isinstance(content, tuple) else content})
+            ids.append(idx)
+        return ids[-1]
+
+def lemma_asts(declare_statements, lemmas):
+    """
+    The DAG of the ASTs of lemmas ({key: lemma text}): nodes, roots (key ->
+    index in nodes) and errors (key -> why the lemma could not be parsed).
+    """
+    digest = hashlib.sha256(declare_statements.encode("utf-8")).hexdigest()
+    dag = AstDag()
+    roots = {}
+    errors = {}
+    with _lock:
+        parser = None
+        for key, text in lemmas.items():
+            ast = _lru_get(_asts, (digest, text))
+            if ast is None:
+                if parser is None:
+                    parser = _get_parser(digest, declare_statements)
+                try:
+                    formula = parser.get_expression(Tokenizer(io.StringIO(text), interactive=False))
+                    if not isinstance(formula, FNode):
+                        #an undeclared symbol is parsed as its name
+                        raise ValueError("not a formula: {}".format(formula))
+                    ast = _convert(formula)
+                except Exception as e:
+                    ast = e
+                    #the parser is left in the middle of the expression, start over with a new one
+                    _parsers.pop(digest, None)
+                    parser = None
+                _lru_put(_asts, (digest, text), ast, LEMMA_AST_CACHE_SIZE)
+            if isinstance(ast, Exception):
+                errors[key] = "{}: {}".format(type(ast).__name__, ast)
+            else:
+                roots[key] = dag.add(ast)
+    return {"nodes": dag.nodes, "roots": roots, "errors": errors}
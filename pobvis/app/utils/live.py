@@ -0,0 +1,166 @@
+"""
+Server-sent events pushing the new nodes of a running experiment.
+
+Each streamed experiment has one ExpTail: a thread that updates the tail
+parser of the experiment (the one poke uses too, so spacer.log is read and
+parsed once) every STREAM_POLL_INTERVAL and pushes the new nodes, with the
+older nodes whose children changed, to the queue of every subscriber. Once
+the experiment is over it pushes its last nodes and a state event and stops.
+It also stops when its last subscriber leaves.
+
+    event: nodes    id: next_node    data: {"from_node", "next_node", "nodes_list"}
+    event: state                     data: {"spacer_state"}
+
+A subscriber too slow to keep up with its queue is dropped and catches up
+from the last next_node it sent, like a client reconnecting with
+Last-Event-ID does.
+"""
+import os
+import json
+import time
+import queue
+import threading
+import traceback
+import app.utils.trace_parsing as ms
+from app.utils.utils import get_exp_state
+from app.settings import MEDIA, STREAM_POLL_INTERVAL, STREAM_KEEPALIVE, STREAM_QUEUE_SIZE
+
+#queue items that are not (next_node, message) pairs
+_RESYNC = "resync"
+_CLOSE = "close"
+
+def sse(event, data, event_id = None):
+    msg = "event: {}\n".format(event)
+    if event_id is not None:
+        msg += "id: {}\n".format(event_id)
+    return msg + "data: {}\n\n".format(data)
+
+class ExpTail(object):
+    #subscribers, next_node and closed are guarded by parser.lock
+    def __init__(self, exp_name):
+        self.exp_name = exp_name
+        self.parser = ms.get_tail_parser(exp_name, os.path.join(MEDIA, exp_name, "spacer.log"))
+        self.subscribers = set()
+        #the nodes before next_node were pushed to the subscribers
+        self.next_node = 0
+        self.closed = False
+        self.thread = None
+
+    def delta_locked(self, from_node):
+        next_node = len(self.parser.all_events)
+        if from_node > next_node:
+            #cursor of another run of the server
+            from_node = 0
+        nodes_list = "".join(self.parser.iter_nodes_json(from_node))
+        data = '{"from_node": %d, "next_node": %d, "nodes_list": %s}' % (from_node, next_node, nodes_list)
+        return next_node, sse("nodes", data, next_node)
+
+    def broadcast_locked(self, item):
+        for q in list(self.subscribers):
+            try:
+                q.put_nowait(item)
+            except queue.Full:
+                self.subscribers.discard(q)
+                while True:
+                    try:
+                        q.get_nowait()
+                    except queue.Empty:
+                        break
+                q.put_nowait(_RESYNC)
+
+    def push_locked(self):
+        self.parser.update()
+        if len(self.parser.all_events) > self.next_node:
+            if self.subscribers:
+                self.broadcast_locked(self.delta_locked(self.next_node))
+            self.next_node = len(self.parser.all_events)
+
+    def close_locked(self, state):
+        self.closed = True
+        self.broadcast_locked((self.next_node, sse("state", json.dumps({"spacer_state": state}))))
+        self.broadcast_locked(_CLOSE)
+        self.subscribers.clear()
+
+    def unsubscribe(self, q):
+        with self.parser.lock:
+            self.subscribers.discard(q)
+
+    def _run(self):
+        try:
+            while True:
+                time.sleep(STREAM_POLL_INTERVAL)
+                #state first, so the last update has everything written before the end
+                state = get_exp_state(self.exp_name)
+                with self.parser.lock:
+                    if not self.subscribers:
+                        self.closed = True
+                        break
+                    self.push_locked()
+                    if state != "running":
+                        self.close_locked(state)
+                        break
+        except Exception:
+            traceback.print_exc()
+            with self.parser.lock:
+                #the subscribers start over with a new ExpTail
+                self.closed = True
+                self.broadcast_locked(_RESYNC)
+                self.subscribers.clear()
+        finally:
+            with _tails_lock:
+                if _tails.get(self.exp_name) is self:
+                    del _tails[self.exp_name]
+
+_tails = {}
+_tails_lock = threading.Lock()
+
+def _subscribe(exp_name, q, from_node):
+    #returns the ExpTail q is now subscribed to and the nodes from from_node to where it is
+    while True:
+        with _tails_lock:
+            tail = _tails.get(exp_name)
+            if tail is None or tail.closed:
+                tail = _tails[exp_name] = ExpTail(exp_name)
+        with tail.parser.lock:
+            if tail.closed:
+                #it stopped in between
+                continue
+            tail.push_locked()
+            first = tail.delta_locked(from_node) if from_node != tail.next_node else None
+            tail.subscribers.add(q)
+            if tail.thread is None:
+                tail.thread = threading.Thread(target=tail._run, daemon=True)
+                tail.thread.start()
+            return tail, first
+
+def events(exp_name, from_node = 0):
+    """The event stream of the experiment, from_node is the next_node the client already has"""
+    q = queue.Queue(STREAM_QUEUE_SIZE)
+    tail = None
+    try:
+        while True:
+            state = get_exp_state(exp_name)
+            if state != "running":
+                #its nodes are fetched with poke
+                yield sse("state", json.dumps({"spacer_state": state}))
+                return
+            tail, first = _subscribe(exp_name, q, from_node)
+            if first is not None:
+                from_node, msg = first
+                yield msg
+            while True:
+                try:
+                    item = q.get(timeout=STREAM_KEEPALIVE)
+                except queue.Empty:
+                    #a comment, keeps proxies from closing an idle stream
+                    yield ": keepalive\n\n"
+                    continue
+                if item is _CLOSE:
+                    return
+                if item is _RESYNC:
+                    break
+                from_node, msg = item
+                yield msg
+    finally:
+        if tail is not None:
+            tail.unsubscribe(q)
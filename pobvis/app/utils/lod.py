@@ -0,0 +1,160 @@
+"""
+Level of detail: a part of the tree of an experiment of bounded size, for
+the traces too big to lay out whole (/spacer/lod).
+
+The tree is decimated breadth first from a root, within a budget of nodes.
+The children of a node are kept in the order: the ones with a subtree of
+their own (the pob chains), then the leaves (mostly the lemmas blocking a
+pob). When they do not all fit, the rest are folded into one count node,
+so a long run of lemmas under a pob shows as a few lemmas and a count.
+Below max_depth (from the root) and once the budget is spent, nodes are
+kept without their children.
+
+A kept node has its children restricted to the kept ones (and its count
+node) and hidden, the number of its descendants that are not under a kept
+child: the ones the client gets by asking for the tree rooted at it.
+The count nodes and the kept nodes with hidden descendants have to_be_vis
+False: the tree is not shown whole under them.
+"""
+import threading
+from collections import deque, OrderedDict
+from app.settings import LOD_TREES
+
+COLLAPSED = "COLLAPSED"
+
+#exp_name -> (children, sizes) of the stored experiments, which do not change
+_trees = OrderedDict()
+#(exp_name, root, max_depth) -> the node_ids of a subtree, sorted, paged by fetch_subtree
+_subtrees = OrderedDict()
+_trees_lock = threading.Lock()
+
+def subtree_sizes(parents):
+    #parents[i] is the parent of node i, which comes before it (the root is its own parent)
+    sizes = [1] * len(parents)
+    for idx in range(len(parents) - 1, 0, -1):
+        sizes[parents[idx]] += sizes[idx]
+    return sizes
+
+def tree_shape(parents):
+    #(children, sizes) from the parent of each node
+    children = [[] for _ in parents]
+    for idx in range(1, len(parents)):
+        children[parents[idx]].append(idx)
+    return children, subtree_sizes(parents)
+
+def stored_tree(exp_name, load_parents):
+    """(children, sizes) of a stored experiment, load_parents() reads its parent column"""
+    with _trees_lock:
+        tree = _trees.get(exp_name)
+        if tree is not None:
+            _trees.move_to_end(exp_name)
+            return tree
+    tree = tree_shape(load_parents())
+    with _trees_lock:
+        _trees[exp_name] = tree
+        while len(_trees) > LOD_TREES:
+            _trees.popitem(last=False)
+    return tree
+
+def subtree_ids(children, root, max_depth = None):
+    #the nodes under root (included), up to max_depth levels below it, sorted
+    ids = [root]
+    level = [root]
+    depth = 0
+    while level and (max_depth is None or depth < max_depth):
+        level = [k for node in level for k in children[node]]
+        ids.extend(level)
+        depth += 1
+    ids.sort()
+    return ids
+
+def stored_subtree(exp_name, root, max_depth, load_parents):
+    """The sorted node_ids of a subtree of a stored experiment, see subtree_ids"""
+    key = (exp_name, root, max_depth)
+    with _trees_lock:
+        ids = _subtrees.get(key)
+        if ids is not None:
+            _subtrees.move_to_end(key)
+            return ids
+    children, sizes = stored_tree(exp_name, load_parents)
+    ids = subtree_ids(children, root, max_depth) if 0 <= root < len(sizes) else []
+    with _trees_lock:
+        _subtrees[key] = ids
+        while len(_subtrees) > LOD_TREES:
+            _subtrees.popitem(last=False)
+    return ids
+
+def forget_tree(exp_name):
+    with _trees_lock:
+        _trees.pop(exp_name, None)
+        for key in [key for key in _subtrees if key[0] == exp_name]:
+            del _subtrees[key]
+
+def decimate(children, sizes, root, budget, max_depth = None):
+    """
+    Decimate the subtree of root: return kept (node -> its kept children,
+    in tree order) and folded (node -> (children folded in its count node,
+    descendants under them)). budget counts the count nodes too.
+    """
+    kept = {root: []}
+    folded = {}
+    left = budget - 1
+    queue = deque([(root, 0)])
+    while queue:
+        node, depth = queue.popleft()
+        kids = children[node]
+        if not kids or left <= 0 or (max_depth is not None and depth >= max_depth):
+            continue
+        ordered = [k for k in kids if children[k]] + [k for k in kids if not children[k]]
+        if len(ordered) > left:
+            #the last place goes to the count node
+            take, rest = ordered[:left - 1], ordered[left - 1:]
+        else:
+            take, rest = ordered, []
+        taken = set(take)
+        kept[node] = [k for k in kids if k in taken]
+        for k in take:
+            kept[k] = []
+        left -= len(take)
+        if rest:
+            folded[node] = (len(rest), sum(sizes[k] for k in rest))
+            left -= 1
+        queue.extend((k, depth + 1) for k in kept[node])
+    return kept, folded
+
+def hidden_count(node, kept, sizes):
+    #descendants of a kept node that are not under its kept children
+    return sizes[node] - 1 - sum(sizes[k] for k in kept[node])
+
+def count_node(parent, count, hidden):
+    #stands for the folded children of parent, in the shape of Event.to_Json
+    return {"nodeID": -(parent + 1),
+            "parent": parent,
+            "children": [],
+            "event_type": COLLAPSED,
+            "expr": "",
+            "level": -1,
+            "exprID": -1,
+            "pobID": -1,
+            "pt_name": "NA",
+            "to_be_vis": False,
+            "count": count,
+            "hidden": hidden}
+
+def lod_nodes(nodes, kept, folded, sizes):
+    """
+    The nodes_list of the result: nodes is an iterable of the kept nodes
+    (as from Event.to_Json), in any order.
+    """
+    nodes_list = {}
+    for node in nodes:
+        idx = node["nodeID"]
+        node["children"] = list(kept[idx])
+        node["hidden"] = hidden_count(idx, kept, sizes)
+        node["to_be_vis"] = node["hidden"] == 0
+        if idx in folded:
+            count, hidden = folded[idx]
+            node["children"].append(-(idx + 1))
+            nodes_list[-(idx + 1)] = count_node(idx, count, hidden)
+        nodes_list[idx] = node
+    return nodes_list
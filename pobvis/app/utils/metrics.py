@@ -0,0 +1,193 @@
+"""
+Timings, counters and gauges of the backend, in the Prometheus text format
+(served at /spacer/metrics).
+
+Every request is timed by endpoint, and the phases of the slow endpoints
+(loading the input, parsing the trace, PROSE round trips, db writes, ...)
+are timed with
+
+    with metrics.timer("parse"):
+        ...
+
+The phases timed during a request are also sent back in a Server-Timing
+header, when TIMING_HEADER is set or the request has X-Server-Timing: 1.
+"""
+import os
+import time
+import bisect
+import threading
+import contextlib
+from flask import g, request
+from app.settings import MEDIA, TIMING_HEADER
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+_lock = threading.Lock()
+_metrics = []
+#phases timed by this thread, when it records them (see recording)
+_local = threading.local()
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def _labels(names, values, extra = ()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, _escape(v)) for k, v in pairs) + "}"
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter(object):
+    kind = "counter"
+    def __init__(self, name, help, labels = ()):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self.values = {}
+
+    def inc(self, amount = 1, **labels):
+        key = tuple(labels[k] for k in self.labels)
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        for key, value in sorted(self.values.items()):
+            yield self.name + _labels(self.labels, key), value
+
+class Histogram(object):
+    kind = "histogram"
+    def __init__(self, name, help, labels = (), buckets = DEFAULT_BUCKETS):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self.buckets = tuple(buckets)
+        #per label values: count of each bucket (not cumulative), sum, count
+        self.values = {}
+
+    def observe(self, value, **labels):
+        key = tuple(labels[k] for k in self.labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with _lock:
+            counts, total, count = self.values.get(key) or ([0] * (len(self.buckets) + 1), 0.0, 0)
+            counts[i] += 1
+            self.values[key] = (counts, total + value, count + 1)
+
+    def samples(self):
+        for key, (counts, total, count) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                yield self.name + "_bucket" + _labels(self.labels, key, [("le", _number(bound))]), cumulative
+            yield self.name + "_sum" + _labels(self.labels, key), total
+            yield self.name + "_count" + _labels(self.labels, key), count
+
+class Gauge(object):
+    #its value is read from a function when the metrics are scraped
+    kind = "gauge"
+    def __init__(self, name, help, read):
+        self.name, self.help, self.read = name, help, read
+
+    def samples(self):
+        yield self.name, self.read()
+
+def register(metric):
+    with _lock:
+        _metrics.append(metric)
+    return metric
+
+def gauge(name, help, read):
+    return register(Gauge(name, help, read))
+
+def render():
+    lines = []
+    with _lock:
+        metrics = list(_metrics)
+    for metric in metrics:
+        try:
+            if isinstance(metric, Gauge):
+                samples = list(metric.samples())
+            else:
+                with _lock:
+                    samples = list(metric.samples())
+        except Exception as e:
+            #a gauge that cannot be read is left out
+            print("metric", metric.name, e)
+            continue
+        lines.append("# HELP {} {}".format(metric.name, metric.help))
+        lines.append("# TYPE {} {}".format(metric.name, metric.kind))
+        lines.extend("{} {}".format(name, _number(value)) for name, value in samples)
+    return "\n".join(lines) + "\n"
+
+REQUEST_SECONDS = register(Histogram("spacer_request_seconds", "Time to handle a request, before streaming the body",
+                                     ("endpoint", "method")))
+REQUESTS = register(Counter("spacer_requests_total", "Requests handled", ("endpoint", "method", "status")))
+PHASE_SECONDS = register(Histogram("spacer_phase_seconds", "Time spent in each phase of the slow endpoints", ("phase",)))
+
+def observe_phase(phase, seconds):
+    PHASE_SECONDS.observe(seconds, phase=phase)
+    phases = getattr(_local, "phases", None)
+    if phases is not None:
+        phases.append((phase, seconds))
+
+@contextlib.contextmanager
+def timer(phase):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_phase(phase, time.perf_counter() - start)
+
+@contextlib.contextmanager
+def recording():
+    """Collect the (phase, seconds) timed by this thread in the block"""
+    previous = getattr(_local, "phases", None)
+    _local.phases = []
+    try:
+        yield _local.phases
+    finally:
+        _local.phases = previous
+
+def _disk_usage(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+class _Cached(object):
+    #walking media is too slow to do on every scrape
+    def __init__(self, read, ttl):
+        self.read, self.ttl = read, ttl
+        self.value, self.time = None, 0
+
+    def __call__(self):
+        now = time.monotonic()
+        if self.value is None or now - self.time > self.ttl:
+            self.value, self.time = self.read(), now
+        return self.value
+
+gauge("spacer_media_bytes", "Size of the files of the experiments in media", _Cached(lambda: _disk_usage(MEDIA), 60))
+
+def _before_request():
+    g._request_start = time.perf_counter()
+    _local.phases = []
+
+def _after_request(response):
+    seconds = time.perf_counter() - g.pop("_request_start", time.perf_counter())
+    endpoint = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    REQUEST_SECONDS.observe(seconds, endpoint=endpoint, method=request.method)
+    REQUESTS.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+    phases = getattr(_local, "phases", None) or []
+    _local.phases = None
+    if TIMING_HEADER or request.headers.get("X-Server-Timing") == "1":
+        timings = ["{};dur={:.1f}".format(phase, s * 1000) for phase, s in phases]
+        timings.append("total;dur={:.1f}".format(seconds * 1000))
+        response.headers["Server-Timing"] = ", ".join(timings)
+    return response
+
+def init_app(app):
+    app.before_request(_before_request)
+    app.after_request(_after_request)
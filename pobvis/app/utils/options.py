@@ -0,0 +1,106 @@
+"""
+Catalog of the options of a z3 binary, as listed by z3 -p.
+
+The catalog is built once per binary (keyed by its path, mtime and size),
+persisted in OPTIONS_CACHE and then served from memory, already serialized
+and with an ETag.
+"""
+import os
+import re
+import json
+import shutil
+import hashlib
+import threading
+from subprocess import check_output
+from app.settings import OPTIONS_CACHE
+
+module_re = re.compile(r"\[module\] ([a-zA-Z]+).*")
+option_re = re.compile(r"    (.*) \((.*)\) \(default: (.*)\)")
+
+_catalogs = {}
+_catalogs_lock = threading.Lock()
+
+def parse_options(lines):
+    result = []
+    prefix = ""
+    for line in lines:
+        module = module_re.search(line)
+        if module:
+            prefix = module.group(1)
+            continue
+        details = option_re.search(line)
+        if details:
+            result.append({"name": (prefix if prefix == "" else prefix + ".") + details.group(1), "type": details.group(2), "default": details.group(3), "dash": True if prefix == "" else False})
+    return result
+
+def _normalize(name):
+    #z3 matches parameter names case insensitively and with - for _
+    return name.lower().replace("-", "_")
+
+class OptionCatalog(object):
+    def __init__(self, options):
+        self.options = options
+        self.json = json.dumps(options)
+        self.etag = hashlib.sha256(self.json.encode("utf-8")).hexdigest()
+        self.types = {}
+        for option in options:
+            self.types[_normalize(option["name"])] = option["type"]
+
+    def check(self, option_tokens):
+        """
+        Check name=value options, return the problems found. Dash options
+        (e.g. -v:1) are z3 command line flags and are only checked when
+        they name a global parameter.
+        """
+        errors = []
+        for token in option_tokens:
+            if token.startswith("-"):
+                name, _, value = token[1:].partition(":")
+                is_flag = True
+            else:
+                name, sep, value = token.partition("=")
+                if sep == "":
+                    errors.append("{}: expected name=value".format(token))
+                    continue
+                is_flag = False
+            option_type = self.types.get(_normalize(name))
+            if option_type is None:
+                if not is_flag:
+                    errors.append("{}: unknown option".format(name))
+                continue
+            if option_type == "bool" and value.lower() not in ("true", "false"):
+                errors.append("{}: expected true or false, got {}".format(name, value))
+            elif option_type == "unsigned int" and not value.isdigit():
+                errors.append("{}: expected an unsigned int, got {}".format(name, value))
+            elif option_type == "double":
+                try:
+                    float(value)
+                except ValueError:
+                    errors.append("{}: expected a double, got {}".format(name, value))
+        return errors
+
+def get_option_catalog(z3_path):
+    binary = os.path.abspath(shutil.which(z3_path) or z3_path)
+    st = os.stat(binary)
+    key = "{}:{}:{}".format(binary, st.st_mtime_ns, st.st_size)
+    with _catalogs_lock:
+        cached = _catalogs.get(binary)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        cache_file = os.path.join(OPTIONS_CACHE, hashlib.sha256(key.encode("utf-8")).hexdigest() + ".json")
+        if os.path.exists(cache_file):
+            with open(cache_file, "r") as f:
+                options = json.load(f)
+        else:
+            output = check_output([binary, "-p"])
+            options = parse_options(output.decode("utf-8").split("\n"))
+            os.makedirs(OPTIONS_CACHE, exist_ok=True)
+            tmp_file = "{}.{}.tmp".format(cache_file, os.getpid())
+            with open(tmp_file, "w") as f:
+                json.dump(options, f)
+            os.replace(tmp_file, cache_file)
+
+        catalog = OptionCatalog(options)
+        _catalogs[binary] = (key, catalog)
+        return catalog
@@ -0,0 +1,155 @@
+"""
+Parses finished experiments in worker processes, so that loading the input
+and parsing a large spacer.log does not hold a request thread.
+
+At most PARSE_WORKERS parses run at once, each in its own process
+(python -m app.utils.parse_workers exp_name) that stores the result in the
+db. Requests for an experiment that is being parsed share its parse (single
+flight): the first one submits it and the others get the same future. While
+it runs, the worker writes how far it is to parse_progress in the exp
+folder, which poke sends back to the callers it asks to retry later, and
+once done the time of each phase to parse_phases, for the metrics. Once
+stored, spacer.log and stderr are compressed (see compression).
+
+A failed parse is remembered with the mtime of spacer.log: the requests get
+its error until the log changes, or one of them asks to retry.
+"""
+import os
+import sys
+import json
+import threading
+import traceback
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, Future
+import app.utils.trace_parsing as ms
+import app.utils.metrics as metrics
+from app.utils.utils import query_db
+from app.utils.compression import compress_exp, find_artifact
+from app.settings import MEDIA, PARSE_WORKERS
+
+PROGRESS_FILE = "parse_progress"
+PHASES_FILE = "parse_phases"
+
+def _write_progress(path, phase, done, total):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"phase": phase, "done": done, "total": total}, f)
+    os.replace(tmp_path, path)
+
+def read_progress(exp_name):
+    try:
+        with open(os.path.join(MEDIA, exp_name, PROGRESS_FILE), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def parse_and_store(exp_name):
+    """Runs in the worker process, return whether the experiment is now in nodes_list"""
+    progress_path = os.path.join(MEDIA, exp_name, PROGRESS_FILE)
+    try:
+        ms.parse_exp(exp_name, progress=lambda phase, done, total: _write_progress(progress_path, phase, done, total))
+        stored = bool(query_db("SELECT 1 FROM nodes_list WHERE exp_name = ?", (exp_name,)))
+        if stored:
+            compress_stored(exp_name)
+        return stored
+    finally:
+        try:
+            os.remove(progress_path)
+        except OSError:
+            pass
+
+def compress_stored(exp_name):
+    #once its nodes are stored, the trace of the experiment is only read back for the exprs
+    try:
+        with metrics.timer("compress"):
+            compress_exp(os.path.join(MEDIA, exp_name))
+    except Exception:
+        #left as it is, it is read the same
+        traceback.print_exc()
+
+def _run_worker(exp_name):
+    #the worker inherits the environment and cwd, so it uses the same db and media
+    exit_code = subprocess.call([sys.executable, "-m", "app.utils.parse_workers", exp_name])
+    #its phases go to the metrics of the server
+    phases_path = os.path.join(MEDIA, exp_name, PHASES_FILE)
+    try:
+        with open(phases_path, "r") as f:
+            for phase, seconds in json.load(f):
+                metrics.observe_phase(phase, seconds)
+        os.remove(phases_path)
+    except (OSError, ValueError):
+        pass
+    if exit_code != 0:
+        raise RuntimeError("parse of {} failed (exit code {})".format(exp_name, exit_code))
+
+def _log_mtime(exp_name):
+    #of spacer.log as it is stored, None if there is none
+    found = find_artifact(os.path.join(MEDIA, exp_name, "spacer.log"))
+    try:
+        return os.path.getmtime(found[0]) if found is not None else None
+    except OSError:
+        return None
+
+class ParsePool(object):
+    def __init__(self, workers = PARSE_WORKERS):
+        self.executor = ThreadPoolExecutor(workers)
+        self.inflight = {}
+        #exp_name -> (mtime of its log when it was submitted, future) of its last parse, if it failed
+        self.failed = {}
+        #done callbacks of futures that are already done run in submit, with the lock held
+        self.lock = threading.RLock()
+
+    def submit(self, exp_name, retry = False):
+        """
+        The future of the parse of the experiment, started unless it already
+        is. The future of a failed parse is returned again while its log has
+        not changed, unless retry.
+        """
+        with self.lock:
+            future = self.inflight.get(exp_name)
+            if future is None:
+                log_mtime = _log_mtime(exp_name)
+                failed = self.failed.pop(exp_name, None)
+                if failed is not None and failed[0] == log_mtime and not retry:
+                    self.failed[exp_name] = failed
+                    return failed[1]
+                future = self.inflight[exp_name] = self.executor.submit(_run_worker, exp_name)
+                future.add_done_callback(lambda f: self._done(exp_name, log_mtime, f))
+            return future
+
+    def run_here(self, exp_name, parse):
+        """
+        Run parse() in this thread as the parse of the experiment (e.g. to
+        finish its tail parser), unless one is in flight: submit returns its
+        future meanwhile. Return (future, whether parse ran here), the future
+        has the result of parse() once done.
+        """
+        with self.lock:
+            future = self.inflight.get(exp_name)
+            if future is not None:
+                return future, False
+            log_mtime = _log_mtime(exp_name)
+            future = self.inflight[exp_name] = Future()
+            future.add_done_callback(lambda f: self._done(exp_name, log_mtime, f))
+        try:
+            future.set_result(parse())
+        except BaseException as e:
+            future.set_exception(e)
+        return future, True
+
+    def _done(self, exp_name, log_mtime, future):
+        with self.lock:
+            if self.inflight.get(exp_name) is future:
+                del self.inflight[exp_name]
+            if not future.cancelled() and future.exception() is not None:
+                self.failed[exp_name] = (log_mtime, future)
+
+if __name__ == '__main__':
+    exp_name = sys.argv[1]
+    with metrics.recording() as phases:
+        try:
+            stored = parse_and_store(exp_name)
+        finally:
+            with open(os.path.join(MEDIA, exp_name, PHASES_FILE), "w") as f:
+                json.dump(phases, f)
+    sys.exit(0 if stored else 1)
@@ -0,0 +1,132 @@
+"""
+Client for the PROSE backend (SpacerProseBackend).
+
+All calls go through one pooled requests.Session, with timeouts and
+retries on connection errors and 502/503/504. Applying a program to a big
+Lemmas map can be split into chunks that are sent concurrently and merged.
+The result of a program on a lemma is cached in the prose_cache table, so
+only the lemmas not seen before with the same program and declarations
+are sent again.
+"""
+import os
+import json
+import time
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from app.settings import PROSEBASEURL, PROSE_TIMEOUT, PROSE_RETRIES, PROSE_POOL_SIZE, PROSE_CHUNK_SIZE, PROSE_CACHE_SIZE
+from app.utils.storage import get_db, transaction
+
+class ProseError(Exception):
+    def __init__(self, status_code, message):
+        super().__init__(message)
+        self.status_code = status_code
+
+def _split(lemmas, chunk_size):
+    keys = list(lemmas)
+    return [{k: lemmas[k] for k in keys[i:i + chunk_size]} for i in range(0, len(keys), chunk_size)]
+
+def _merge(responses):
+    #the chunks answer with the same shape: a map keyed by lemma, or a list
+    if all(isinstance(r, dict) for r in responses):
+        merged = {}
+        for r in responses:
+            merged.update(r)
+        return merged
+    if all(isinstance(r, list) for r in responses):
+        return [x for r in responses for x in r]
+    raise ProseError(502, "cannot merge the responses of PROSE for a chunked request")
+
+class ProseClient(object):
+    def __init__(self, base_url = PROSEBASEURL, timeout = PROSE_TIMEOUT, retries = PROSE_RETRIES,
+                 pool_size = PROSE_POOL_SIZE, chunk_size = PROSE_CHUNK_SIZE):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self.session = requests.Session()
+        #the transformation endpoints have no side effect, so POST can be retried
+        retry = Retry(total=retries, backoff_factor=0.5, status_forcelist=(502, 503, 504),
+                      allowed_methods=None, raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.executor = ThreadPoolExecutor(max_workers=pool_size)
+
+    def post(self, path, body):
+        url = os.path.join(self.base_url, *path)
+        try:
+            response = self.session.post(url, json=body, timeout=self.timeout)
+        except requests.Timeout as e:
+            raise ProseError(504, "PROSE timed out: {}".format(e))
+        except requests.RequestException as e:
+            raise ProseError(502, "cannot reach PROSE: {}".format(e))
+        if response.status_code != 200:
+            raise ProseError(response.status_code, "PROSE answered {}".format(response.status_code))
+        return response.json()
+
+    def learn_transformation(self, body):
+        return self.post(('transformations', 'learntransformation'), body)
+
+    def apply_transformation(self, path, body, exp_name, lemmas, chunk_size = None):
+        """
+        POST body to path with spacerInstance = {"Id": exp_name, "Lemmas": lemmas}.
+        With a chunk_size (default PROSE_CHUNK_SIZE, 0 for none), lemmas is
+        sent in chunks of that many lemmas, concurrently, and the responses
+        are merged.
+        """
+        if chunk_size is None:
+            chunk_size = self.chunk_size
+        if not chunk_size or len(lemmas) <= chunk_size:
+            chunks = [lemmas]
+        else:
+            chunks = _split(lemmas, chunk_size)
+
+        def _post_chunk(chunk):
+            chunk_body = dict(body)
+            chunk_body['spacerInstance'] = json.dumps({"Id": exp_name, "Lemmas": chunk})
+            return self.post(path, chunk_body)
+
+        if len(chunks) == 1:
+            return _post_chunk(chunks[0])
+        return _merge(list(self.executor.map(_post_chunk, chunks)))
+
+def lemma_cache_keys(program, declare_statements, lemmas):
+    """
+    Key of the result of applying program to each lemma: the hash of the
+    program (as in learned_programs), of the lemma and of the declarations.
+    """
+    program_hash = hashlib.sha256(program.encode('utf-8')).hexdigest()
+    decls_hash = hashlib.sha256(declare_statements.encode('utf-8')).hexdigest()
+    keys = {}
+    for lemma_id, lemma in lemmas.items():
+        lemma_hash = hashlib.sha256(json.dumps(lemma, sort_keys=True).encode('utf-8')).hexdigest()
+        keys[lemma_id] = hashlib.sha256((program_hash + lemma_hash + decls_hash).encode('utf-8')).hexdigest()
+    return keys
+
+def get_cached_results(keys):
+    #{key: result} for the keys in the cache, which are marked as used
+    cached = {}
+    keys = list(keys)
+    db = get_db()
+    for i in range(0, len(keys), 500):
+        batch = keys[i:i + 500]
+        rows = db.execute('SELECT key, value FROM prose_cache WHERE key IN ({})'.format(",".join("?" * len(batch))), batch).fetchall()
+        for row in rows:
+            cached[row['key']] = json.loads(row['value'])
+    now = time.time()
+    with transaction():
+        db.executemany('UPDATE prose_cache SET last_used = ? WHERE key = ?', ((now, key) for key in cached))
+    return cached
+
+def put_cached_results(results):
+    #results is {key: result}, the least recently used entries beyond PROSE_CACHE_SIZE are evicted
+    if not results:
+        return
+    now = time.time()
+    with transaction() as db:
+        db.executemany('REPLACE INTO prose_cache(key, value, last_used) VALUES (?,?,?)',
+                       ((key, json.dumps(value), now) for key, value in results.items()))
+        db.execute('DELETE FROM prose_cache WHERE key IN (SELECT key FROM prose_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?)',
+                   (PROSE_CACHE_SIZE,))
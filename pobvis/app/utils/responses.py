@@ -0,0 +1,159 @@
+"""
+Encoding, compression and caching of the JSON responses.
+
+dumps encodes with orjson when it is installed (it is optional, like
+zstandard in compression), else with json: the same JSON, up to whitespace
+and the escaping of non-ASCII characters.
+
+init_app compresses the responses as the Accept-Encoding of the client
+asks (gzip, or zstd when zstandard is installed), streamed ones chunk by
+chunk as they are sent. Small responses, event streams and responses that
+are already encoded are left as they are. A compressed response gets the
+encoding appended to its ETag, so that each representation has its own
+strong ETag, and not_modified accepts any of them.
+
+cached_response serves a JSON body that does not change (the poke result
+of a finished experiment) from a gzipped file written the first time it is
+asked for: a client that accepts gzip gets the bytes of the file as they
+are, the others get them decompressed as they are sent.
+"""
+import os
+import json
+import gzip
+import zlib
+import threading
+from flask import request, Response, send_file
+from app.utils.compression import GZIP_LEVEL, COPY_BUFFER
+from app.settings import COMPRESS_MIN_SIZE
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+#in the order preferred when the client accepts several equally
+ENCODINGS = ("zstd", "gzip") if zstandard is not None else ("gzip",)
+
+def dumps(obj):
+    """obj as JSON, in bytes"""
+    if orjson is not None:
+        #json turns the int keys (e.g. of an expr_map) into strings, orjson only with this option
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj).encode("utf-8")
+
+def accepted_encoding():
+    #the encoding to send the response of the current request in, None for none
+    encoding = request.accept_encodings.best_match(ENCODINGS)
+    return encoding if encoding in ENCODINGS else None
+
+def not_modified(etag):
+    #whether the client has the response with this ETag, in any encoding
+    if_none_match = request.if_none_match
+    return if_none_match.contains(etag) or any(if_none_match.contains(_encoded_etag(etag, encoding))
+                                               for encoding in ENCODINGS)
+
+def _encoded_etag(etag, encoding):
+    return "{}-{}".format(etag, encoding)
+
+def _compress(body, encoding):
+    if encoding == "gzip":
+        return gzip.compress(body, GZIP_LEVEL)
+    return zstandard.ZstdCompressor().compress(body)
+
+def _compressobj(encoding):
+    if encoding == "gzip":
+        #wbits 31: with the gzip header and trailer
+        return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+    return zstandard.ZstdCompressor().compressobj()
+
+def _compress_chunks(chunks, encoding):
+    compressor = _compressobj(encoding)
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode("utf-8")
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+    finally:
+        #stream_with_context closes the request context when its generator is closed
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+def _after_request(response):
+    etag, weak = response.get_etag()
+    if response.status_code == 304:
+        #the ETag the client sent, compressed or not
+        for encoding in ENCODINGS:
+            if etag is not None and request.if_none_match.contains(_encoded_etag(etag, encoding)):
+                response.set_etag(_encoded_etag(etag, encoding), weak)
+        return response
+    if (response.status_code != 200 or "Content-Encoding" in response.headers
+            or response.mimetype == "text/event-stream" or response.direct_passthrough):
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding = accepted_encoding()
+    if encoding is None:
+        return response
+    if response.is_streamed:
+        response.response = _compress_chunks(response.response, encoding)
+        response.headers.pop("Content-Length", None)
+    else:
+        body = response.get_data()
+        if len(body) < COMPRESS_MIN_SIZE:
+            return response
+        response.set_data(_compress(body, encoding))
+    response.headers["Content-Encoding"] = encoding
+    if etag is not None:
+        response.set_etag(_encoded_etag(etag, encoding), weak)
+    return response
+
+def init_app(app):
+    app.after_request(_after_request)
+
+def etag_response(body, etag, mimetype="application/json"):
+    #304 if the client already has this version, for POST requests too
+    if not_modified(etag):
+        response = Response(status=304)
+    else:
+        response = Response(body, mimetype=mimetype)
+    response.set_etag(etag)
+    return response
+
+def _write_gzipped(path, chunks):
+    tmp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+    with gzip.open(tmp_path, "wb", compresslevel=GZIP_LEVEL) as f:
+        for chunk in chunks:
+            f.write(chunk.encode("utf-8") if isinstance(chunk, str) else chunk)
+    os.replace(tmp_path, path)
+
+def _read_gzipped(path):
+    with gzip.open(path, "rb") as f:
+        for block in iter(lambda: f.read(COPY_BUFFER), b""):
+            yield block
+
+def cached_response(cache_path, etag, chunks):
+    """
+    The JSON response made of chunks() (str or bytes), with this ETag,
+    from the gzipped file at cache_path, written first if it is not there.
+    """
+    if not_modified(etag):
+        return etag_response(b"", etag)
+    if not os.path.exists(cache_path):
+        _write_gzipped(cache_path, chunks())
+    if request.accept_encodings["gzip"] > 0:
+        response = send_file(cache_path, mimetype="application/json", etag=False, conditional=False)
+        response.headers["Content-Encoding"] = "gzip"
+        response.vary.add("Accept-Encoding")
+        response.set_etag(_encoded_etag(etag, "gzip"))
+        return response
+    #compressed again by _after_request if the client accepts zstd
+    response = Response(_read_gzipped(cache_path), mimetype="application/json")
+    response.set_etag(etag)
+    return response
@@ -0,0 +1,263 @@
+"""
+SQLite storage: connections, transactions and the schema of exp_db.
+
+Connections use WAL so that the endpoints polling the db do not block on
+writers. There is one connection per app context (closed on teardown) and
+one per thread outside of requests (job manager, parse workers).
+
+The schema is versioned with PRAGMA user_version: migrate() applies the
+migrations an existing exp_db has not seen yet, in place.
+
+    python3 -m app.utils.storage    # create or upgrade exp_db
+"""
+import sqlite3
+import threading
+import contextlib
+from flask import g, has_app_context
+import app.utils.metrics as metrics
+from app.settings import DATABASE
+
+_local = threading.local()
+
+class Connection(sqlite3.Connection):
+    #depth of nested transaction() blocks, commit() is a no-op inside them
+    tx_depth = 0
+
+def connect(database = DATABASE):
+    db = sqlite3.connect(database, timeout=30, factory=Connection)
+    db.row_factory = sqlite3.Row
+    db.execute("PRAGMA journal_mode=WAL")
+    #with WAL, NORMAL only risks the last transactions on power loss, not corruption
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.execute("PRAGMA temp_store=MEMORY")
+    db.execute("PRAGMA cache_size=-32000")
+    db.execute("PRAGMA mmap_size=268435456")
+    return db
+
+def get_db():
+    if has_app_context():
+        db = getattr(g, '_database', None)
+        if db is None:
+            db = g._database = connect()
+        return db
+    db = getattr(_local, 'db', None)
+    if db is None:
+        db = _local.db = connect()
+    return db
+
+def close_db(exception = None):
+    db = g.pop('_database', None)
+    if db is not None:
+        db.close()
+
+def init_app(app):
+    app.teardown_appcontext(close_db)
+
+def commit():
+    #commit, unless a transaction() block will do it
+    db = get_db()
+    if db.tx_depth == 0:
+        db.commit()
+
+@contextlib.contextmanager
+def transaction():
+    """
+    Group writes in one transaction, committed at the end of the outermost
+    block and rolled back if it raises. BEGIN IMMEDIATE takes the write lock
+    upfront, so reads in the block see the state the writes apply to.
+    """
+    db = get_db()
+    if db.tx_depth > 0:
+        db.tx_depth += 1
+        try:
+            yield db
+        finally:
+            db.tx_depth -= 1
+        return
+    with metrics.timer("db_write"):
+        if db.in_transaction:
+            db.commit()
+        db.execute("BEGIN IMMEDIATE")
+        db.tx_depth = 1
+        try:
+            yield db
+        except:
+            db.tx_depth = 0
+            db.rollback()
+            raise
+        db.tx_depth = 0
+        db.commit()
+
+def _add_column(db, table, column, definition):
+    columns = [row[1] for row in db.execute("PRAGMA table_info({})".format(table))]
+    if column not in columns:
+        db.execute("ALTER TABLE {} ADD COLUMN {} {}".format(table, column, definition))
+
+def _initial_schema(db):
+    db.execute("CREATE TABLE IF NOT EXISTS exp(exp_name VARCHAR(100), done BOOL, result VARCHAR(5), time INT, aux VARCHAR(200))")
+    db.execute("CREATE TABLE IF NOT EXISTS expr_map(exp_name VARCHAR(100), expr_id INT, value TEXT, PRIMARY KEY ( exp_name, expr_id))")
+    db.execute("CREATE TABLE IF NOT EXISTS nodes_list(exp_name VARCHAR(100), nodes_list TEXT, PRIMARY KEY (exp_name))")
+    db.execute("CREATE TABLE IF NOT EXISTS learned_programs(hash VARCHAR(256), human_readable_ast TEXT, xml_ast TEXT, comment TEXT, PRIMARY KEY(hash))")
+
+def _nodes_table(db):
+    #nodes_list only keeps the rest of a parsed experiment (status, run_cmd, ...), the nodes are in nodes, one row per node
+    db.execute("CREATE TABLE IF NOT EXISTS nodes(exp_name VARCHAR(100), node_id INT, parent INT, children TEXT, event_type VARCHAR(20), expr TEXT, level INT, expr_id INT, pob_id INT, pt_name TEXT, PRIMARY KEY (exp_name, node_id))")
+    db.execute("CREATE INDEX IF NOT EXISTS nodes_parent ON nodes(exp_name, parent)")
+    db.execute("CREATE INDEX IF NOT EXISTS nodes_level ON nodes(exp_name, level)")
+    db.execute("CREATE INDEX IF NOT EXISTS nodes_pob_id ON nodes(exp_name, pob_id)")
+    db.execute("CREATE INDEX IF NOT EXISTS nodes_expr_id ON nodes(exp_name, expr_id)")
+
+def _job_columns(db):
+    #maintained by the job manager (utils/jobs.py)
+    _add_column(db, "exp", "state", "VARCHAR(10)")
+    _add_column(db, "exp", "pid", "INT")
+    _add_column(db, "exp", "started", "REAL")
+    _add_column(db, "exp", "exit_code", "INT")
+
+def _batch_table(db):
+    #runs of a parameter sweep (start_batch), options are the ones specific to the run
+    db.execute("CREATE TABLE IF NOT EXISTS batch(batch_id VARCHAR(100), exp_name VARCHAR(100), options TEXT, PRIMARY KEY (batch_id, exp_name))")
+
+def _prose_cache_table(db):
+    #result of a program on a lemma, keyed by the hashes of (program, lemma, declare statements)
+    db.execute("CREATE TABLE IF NOT EXISTS prose_cache(key VARCHAR(64), value TEXT, last_used REAL, PRIMARY KEY(key))")
+    db.execute("CREATE INDEX IF NOT EXISTS prose_cache_last_used ON prose_cache(last_used)")
+
+def _expr_map_versions(db):
+    #every save_exprs is a new version of the expr_map of the experiment, removed exprs are kept with deleted = 1
+    _add_column(db, "expr_map", "version", "INT DEFAULT 0")
+    _add_column(db, "expr_map", "deleted", "BOOL DEFAULT 0")
+    db.execute("CREATE INDEX IF NOT EXISTS expr_map_version_idx ON expr_map(exp_name, version)")
+    db.execute("CREATE TABLE IF NOT EXISTS expr_map_version(exp_name VARCHAR(100), version INT, PRIMARY KEY (exp_name))")
+
+def _query_indexes(db):
+    #exp has no primary key, but every endpoint looks experiments up by name
+    db.execute("CREATE INDEX IF NOT EXISTS exp_name_idx ON exp(exp_name)")
+    #JobManager.recover
+    db.execute("CREATE INDEX IF NOT EXISTS exp_done_state ON exp(done, state)")
+    db.execute("CREATE INDEX IF NOT EXISTS batch_exp_name ON batch(exp_name)")
+
+def _exp_row_versions(db):
+    #every insert, update and delete of an exp row takes the next exp_version, fetch_exps polls with it
+    _add_column(db, "exp", "row_version", "INT DEFAULT 0")
+    db.execute("CREATE TABLE IF NOT EXISTS exp_version(version INT)")
+    db.execute("CREATE TABLE IF NOT EXISTS exp_tombstones(exp_name VARCHAR(100), row_version INT)")
+    db.execute("UPDATE exp SET row_version = rowid")
+    db.execute("DELETE FROM exp_version")
+    db.execute("INSERT INTO exp_version(version) SELECT IFNULL(MAX(rowid), 0) FROM exp")
+    db.execute("CREATE INDEX IF NOT EXISTS exp_row_version ON exp(row_version)")
+    db.execute("CREATE INDEX IF NOT EXISTS exp_tombstones_row_version ON exp_tombstones(row_version)")
+    bump = "UPDATE exp_version SET version = version + 1;"
+    db.execute("CREATE TRIGGER IF NOT EXISTS exp_inserted AFTER INSERT ON exp BEGIN " + bump +
+               " UPDATE exp SET row_version = (SELECT version FROM exp_version) WHERE rowid = NEW.rowid; END")
+    #the guard skips the update of row_version done by the triggers themselves
+    db.execute("CREATE TRIGGER IF NOT EXISTS exp_updated AFTER UPDATE ON exp WHEN NEW.row_version IS OLD.row_version BEGIN " + bump +
+               " UPDATE exp SET row_version = (SELECT version FROM exp_version) WHERE rowid = NEW.rowid; END")
+    db.execute("CREATE TRIGGER IF NOT EXISTS exp_deleted AFTER DELETE ON exp BEGIN " + bump +
+               " INSERT INTO exp_tombstones(exp_name, row_version) SELECT OLD.exp_name, version FROM exp_version; END")
+
+def _exp_summary_table(db):
+    #aggregates computed when the experiment is parsed (ExpSummary in trace_parsing), as JSON
+    db.execute("CREATE TABLE IF NOT EXISTS exp_summary(exp_name VARCHAR(100), summary TEXT, PRIMARY KEY (exp_name))")
+
+def _search_index(db):
+    #inverted index of the exprs of the nodes, node_tokens_done lists the experiments it covers
+    db.execute("CREATE TABLE IF NOT EXISTS node_tokens(exp_name VARCHAR(100), token TEXT, node_id INT, PRIMARY KEY (exp_name, token, node_id)) WITHOUT ROWID")
+    db.execute("CREATE TABLE IF NOT EXISTS node_tokens_done(exp_name VARCHAR(100), PRIMARY KEY (exp_name))")
+    db.execute("CREATE INDEX IF NOT EXISTS nodes_pt_name ON nodes(exp_name, pt_name)")
+    db.execute("CREATE INDEX IF NOT EXISTS nodes_event_type ON nodes(exp_name, event_type)")
+
+def _interned_exprs(db):
+    #the distinct exprs of an experiment, keyed by the node_id of the first node with it;
+    #the nodes refer to theirs by expr_ref and leave expr NULL, except the ones stored before
+    db.execute("CREATE TABLE IF NOT EXISTS node_exprs(exp_name VARCHAR(100), expr_ref INT, expr TEXT, PRIMARY KEY (exp_name, expr_ref))")
+    _add_column(db, "nodes", "expr_ref", "INT")
+    db.execute("CREATE VIEW IF NOT EXISTS nodes_with_exprs AS SELECT nodes.exp_name AS exp_name, node_id, parent, children, event_type,"
+               " IFNULL(nodes.expr, node_exprs.expr) AS expr, level, expr_id, pob_id, pt_name, nodes.expr_ref AS expr_ref"
+               " FROM nodes LEFT JOIN node_exprs ON node_exprs.exp_name = nodes.exp_name AND node_exprs.expr_ref = nodes.expr_ref")
+
+def _node_generations(db):
+    #the rows of a parse in nodes, node_exprs and node_tokens are under a key of their own, its generation (see save_nodes);
+    #stored_nodes_key has the one in use for each experiment, and the stored_ views its rows under the exp_name
+    db.execute("CREATE TABLE IF NOT EXISTS stored_nodes_key(exp_name VARCHAR(100), nodes_key VARCHAR(150), PRIMARY KEY (exp_name))")
+    db.execute("INSERT OR IGNORE INTO stored_nodes_key(exp_name, nodes_key) SELECT DISTINCT exp_name, exp_name FROM nodes")
+    db.execute("CREATE VIEW IF NOT EXISTS stored_nodes AS SELECT stored_nodes_key.exp_name AS exp_name, node_id, parent, children,"
+               " event_type, expr, level, expr_id, pob_id, pt_name, expr_ref"
+               " FROM stored_nodes_key JOIN nodes ON nodes.exp_name = stored_nodes_key.nodes_key")
+    db.execute("CREATE VIEW IF NOT EXISTS stored_node_exprs AS SELECT stored_nodes_key.exp_name AS exp_name, expr_ref, expr"
+               " FROM stored_nodes_key JOIN node_exprs ON node_exprs.exp_name = stored_nodes_key.nodes_key")
+    db.execute("CREATE VIEW IF NOT EXISTS stored_node_tokens AS SELECT stored_nodes_key.exp_name AS exp_name, token, node_id"
+               " FROM stored_nodes_key JOIN node_tokens ON node_tokens.exp_name = stored_nodes_key.nodes_key")
+    db.execute("DROP VIEW IF EXISTS nodes_with_exprs")
+    db.execute("CREATE VIEW nodes_with_exprs AS SELECT stored_nodes_key.exp_name AS exp_name, node_id, parent, children, event_type,"
+               " IFNULL(nodes.expr, node_exprs.expr) AS expr, level, expr_id, pob_id, pt_name, nodes.expr_ref AS expr_ref"
+               " FROM stored_nodes_key JOIN nodes ON nodes.exp_name = stored_nodes_key.nodes_key"
+               " LEFT JOIN node_exprs ON node_exprs.exp_name = nodes.exp_name AND node_exprs.expr_ref = nodes.expr_ref")
+
+def _exp_ids(db):
+    #fetch_exps pages by exp_id: exp has no INTEGER PRIMARY KEY, so VACUUM may renumber its rowids.
+    #it is the exp_version the row was inserted at, the rowid for the rows already there
+    _add_column(db, "exp", "exp_id", "INT")
+    #not an update of the rows for the clients polling by version
+    db.execute("DROP TRIGGER IF EXISTS exp_updated")
+    db.execute("UPDATE exp SET exp_id = rowid")
+    db.execute("CREATE UNIQUE INDEX IF NOT EXISTS exp_id_idx ON exp(exp_id)")
+    bump = "UPDATE exp_version SET version = version + 1;"
+    db.execute("DROP TRIGGER IF EXISTS exp_inserted")
+    db.execute("CREATE TRIGGER exp_inserted AFTER INSERT ON exp BEGIN " + bump +
+               " UPDATE exp SET row_version = (SELECT version FROM exp_version), exp_id = (SELECT version FROM exp_version) WHERE rowid = NEW.rowid; END")
+    db.execute("CREATE TRIGGER exp_updated AFTER UPDATE ON exp WHEN NEW.row_version IS OLD.row_version BEGIN " + bump +
+               " UPDATE exp SET row_version = (SELECT version FROM exp_version) WHERE rowid = NEW.rowid; END")
+    #uploaded experiments were inserted without a state, the state filter of fetch_exps never selected them
+    db.execute("UPDATE exp SET state = 'uploaded' WHERE state IS NULL")
+
+def _search_pt_names(db):
+    #the pt_name ptName searches match, the one of a lemma is not its node pt_name (NA) but the line after its header;
+    #the lemmas stored before keep NA, their lines are gone until they are parsed again
+    _add_column(db, "nodes", "search_pt_name", "TEXT")
+    db.execute("UPDATE nodes SET search_pt_name = pt_name")
+    db.execute("CREATE INDEX IF NOT EXISTS nodes_search_pt_name ON nodes(exp_name, search_pt_name)")
+    db.execute("DROP VIEW IF EXISTS stored_nodes")
+    db.execute("CREATE VIEW stored_nodes AS SELECT stored_nodes_key.exp_name AS exp_name, node_id, parent, children,"
+               " event_type, expr, level, expr_id, pob_id, pt_name, expr_ref, search_pt_name"
+               " FROM stored_nodes_key JOIN nodes ON nodes.exp_name = stored_nodes_key.nodes_key")
+
+#migration i brings the schema from user_version i to i + 1, never edit one that shipped
+migrations = [
+    _initial_schema,
+    _nodes_table,
+    _job_columns,
+    _batch_table,
+    _prose_cache_table,
+    _expr_map_versions,
+    _query_indexes,
+    _exp_row_versions,
+    _exp_summary_table,
+    _search_index,
+    _interned_exprs,
+    _node_generations,
+    _exp_ids,
+    _search_pt_names,
+]
+
+def migrate(database = DATABASE):
+    """Apply the pending migrations, return the schema version"""
+    db = connect(database)
+    try:
+        version = db.execute("PRAGMA user_version").fetchone()[0]
+        for i in range(version, len(migrations)):
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                migrations[i](db)
+                db.execute("PRAGMA user_version = {}".format(i + 1))
+                db.commit()
+            except:
+                db.rollback()
+                raise
+            print("exp_db migrated to version", i + 1)
+        return len(migrations)
+    finally:
+        db.close()
+
+if __name__ == '__main__':
+    migrate()
@@ -1,18 +1,22 @@
 """A parser for spacer output."""
 
-import logging
 import re
-from collections import namedtuple
+from collections import OrderedDict
 import json
 from enum import Enum
 import sys
 import os
-from app.settings import DATABASE, MEDIA
+from app.settings import MEDIA, TAIL_PARSERS
 from app.utils.utils import *
 import traceback
-import z3
-from chctools import horndb as H
-import io
+from app.utils.var_decls import get_var_decls
+from app.utils.compression import find_artifact, open_artifact, decoding
+import app.utils.metrics as metrics
+import threading
+import contextlib
+import bisect
+import itertools
+import hashlib
 
 class EType(Enum):
     EXP_LVL = 0
@@ -40,6 +44,15 @@ class ParsedLine (object):
         }
 
 class Event (object):
+    #one Event is kept per node for the whole trace: its lines are dropped
+    #once it is finalized and its expr is kept either as text or, when it
+    #was parsed from a file, as the (start, end) byte span of the text.
+    #expr_ref is the idx of the first event with the same expr.
+    #search_pt_name is the pt_name a search by ptName matches: the one of
+    #a lemma is the line after its header, its node pt_name stays NA
+    __slots__ = ("lines", "idx", "event_type", "parent", "children", "exprID",
+                 "pobID", "level", "depth", "pt_name", "search_pt_name", "expr", "expr_span", "expr_ref")
+
     def __init__(self, idx, parent = None):
         self.lines = []
         self.idx = idx
@@ -49,12 +62,17 @@ class Event (object):
         self.exprID = -1
         self.pobID = -1
         self.level = -1
+        self.depth = -1
         self.pt_name = "NA"
+        self.search_pt_name = "NA"
+        self.expr = ""
+        self.expr_span = None
+        self.expr_ref = idx
 
     def add_line(self, line):
         self.lines.append(line)
 
-    def finalize(self, all_events):
+    def finalize(self, index):
         if self.lines[0].startswith("* LEVEL"):
             self.event_type = EType.EXP_LVL
             self.level = int(self.lines[0].strip().split()[-1])
@@ -74,6 +92,7 @@ class Event (object):
                 self.pobID = int(pobID)
 
             self.pt_name = pt_name
+            self.search_pt_name = pt_name
  
         elif self.lines[0].startswith("** add-lemma"):
             _, label0, level, label1, exprID, label2, pobID = self.lines[0].strip().split()[:7]
@@ -87,34 +106,34 @@ class Event (object):
             assert(label2=="pobID:")
             self.pobID = int(pobID)
             self.event_type = EType.ADD_LEM
+            if len(self.lines) > 1:
+                self.search_pt_name = self.lines[1].strip()
         elif self.lines[0].startswith("Propagating"):
             self.event_type = EType.PRO_LEM
-        parent_event = self.find_parent(all_events)
+        parent_event = self.find_parent(index)
         parent_event.children.append(self.idx)
         self.parent = parent_event.idx
         
-    def find_parent(self, all_events):
+    def find_parent(self, index):
         #Return None if the node should be merged with the parent
         #Return the parent otherwise
         if self.event_type == EType.ADD_LEM:
             #Adding lemma is the child event of the latest EXP_POB or Propagating
-            if all_events[-1].event_type == EType.EXP_POB:
-                return all_events[-1]
-            else:
-                for e in reversed(all_events):
-                    if e.event_type == EType.PRO_LEM:
-                        return e
+            if index.last.event_type == EType.EXP_POB:
+                return index.last
+            elif index.latest_pro is not None:
+                return index.latest_pro
         elif self.event_type == EType.EXP_POB:
            # is the child of the previous one if level = prev_level-1
-            prev_event = all_events[-1]
+            prev_event = index.last
             if prev_event.event_type == EType.EXP_POB and prev_event.level == self.level + 1:
                 return prev_event
             # else, find the latest one with greater level
-            for e in reversed(all_events):
-                if e.event_type == EType.EXP_LVL:
-                    return e
-                elif e.event_type == EType.EXP_POB and e.level > self.level:
-                    return e
+            pob = index.latest_pob_above(self.level)
+            if pob is not None:
+                return pob
+            if index.latest_lvl is not None:
+                return index.latest_lvl
 
             # only expect this to happen once because 'enter level 0' event is not produced
             print(self.lines)
@@ -122,20 +141,24 @@ class Event (object):
            
         elif self.event_type == EType.PRO_LEM:
             #Propagating is the child event of the latest EXP_LVL event
-            for e in reversed(all_events):
-                if e.event_type == EType.EXP_LVL:
-                    return e
+            if index.latest_lvl is not None:
+                return index.latest_lvl
 
-        return all_events[0]
+        return index.root
 
 
 
-    def to_Json(self):
+    def expr_start(self):
+        #number of header lines before the expr
         if self.event_type==EType.ADD_LEM:
-            expr = "".join(self.lines[2:])
-        else:
-            expr = "".join(self.lines[1:])
-        return {"nodeID": self.idx,
+            return 2
+        return 1
+
+    def to_Json(self, expr = None, interned = False):
+        #interned: exprRef instead of the expr, which is sent once in exprs
+        if expr is None:
+            expr = self.expr
+        node = {"nodeID": self.idx,
                 "parent": self.parent,
                 "children": self.children,
                 "event_type": str(self.event_type),
@@ -145,97 +168,513 @@ class Event (object):
                 "pobID": self.pobID,
                 "pt_name": self.pt_name,
                 "to_be_vis": True}
+        if interned:
+            del node["expr"]
+            node["exprRef"] = self.expr_ref
+        return node
 
-def parse(lines):
-    timer = 1
-    all_events = [Event(0)]
-    event = Event(idx = timer)
+class ParentIndex(object):
+    """
+    Running indexes over the finalized events, so that find_parent does not
+    have to walk back through all of them: the last event, the latest
+    EXP_LVL and PRO_LEM, and a stack of the pobs expanded since the latest
+    EXP_LVL. A pob shadows the older ones with a lower or equal level (it is
+    a better candidate parent for any later pob), so levels on the stack are
+    strictly decreasing and the latest pob above a level is a binary search.
+    """
+    def __init__(self, root):
+        self.root = root
+        self.last = root
+        self.latest_lvl = None
+        self.latest_pro = None
+        self.pobs = []
+        self.neg_pob_levels = [] #increasing, for bisect
+
+    def add(self, event):
+        if event.event_type == EType.EXP_LVL:
+            #every pob before this level is shadowed by it
+            self.latest_lvl = event
+            self.pobs = []
+            self.neg_pob_levels = []
+        elif event.event_type == EType.PRO_LEM:
+            self.latest_pro = event
+        elif event.event_type == EType.EXP_POB:
+            while self.pobs and self.pobs[-1].level <= event.level:
+                self.pobs.pop()
+                self.neg_pob_levels.pop()
+            self.pobs.append(event)
+            self.neg_pob_levels.append(-event.level)
+        self.last = event
 
-    for line in lines:
+    def latest_pob_above(self, level):
+        #latest pob expanded since the latest EXP_LVL with a level > level
+        i = bisect.bisect_left(self.neg_pob_levels, -level)
+        return self.pobs[i - 1] if i > 0 else None
+
+class ExpSummary(object):
+    """
+    Aggregates of the events, for the overview charts, kept up to date as
+    the events are finalized: pobs and lemmas per level, per pt_name and
+    per depth, lemmas at level oo vs at a finite level, the highest level
+    reached. The pt_name of a lemma is the line after its header, its depth
+    the one of the pob it blocks (none for the lemmas of a propagation).
+    """
+    def __init__(self):
+        self.events = 0
+        self.max_level = -1
+        self.max_depth = -1
+        self.propagations = 0
+        self.pobs = self._counts()
+        self.lemmas = self._counts()
+        self.lemmas_oo = 0
+
+    @staticmethod
+    def _counts():
+        return {"count": 0, "per_level": {}, "per_pt": {}, "per_depth": {}}
+
+    @staticmethod
+    def _count(counts, level, pt_name, depth):
+        counts["count"] += 1
+        for key, value in (("per_level", level), ("per_pt", pt_name), ("per_depth", depth)):
+            if value is not None:
+                counts[key][value] = counts[key].get(value, 0) + 1
+
+    def add(self, event, parent):
+        #called with the lines of the event, before they are dropped
+        self.events += 1
+        if event.event_type == EType.EXP_LVL:
+            self.max_level = max(self.max_level, event.level)
+        elif event.event_type == EType.PRO_LEM:
+            self.propagations += 1
+        elif event.event_type == EType.EXP_POB:
+            self.max_depth = max(self.max_depth, event.depth)
+            self._count(self.pobs, event.level, event.pt_name, event.depth)
+        elif event.event_type == EType.ADD_LEM:
+            depth = parent.depth if parent.event_type == EType.EXP_POB else None
+            if event.level == "oo":
+                self.lemmas_oo += 1
+            self._count(self.lemmas, event.level, event.search_pt_name, depth)
+
+    def to_Json(self):
+        return {"events": self.events,
+                "max_level": self.max_level,
+                "max_depth": self.max_depth,
+                "propagations": self.propagations,
+                "pobs": self.pobs,
+                "lemmas": dict(self.lemmas, oo=self.lemmas_oo, finite=self.lemmas["count"] - self.lemmas_oo)}
+
+def _expr_digest(expr):
+    return hashlib.blake2b(expr.encode("utf-8"), digest_size=16).digest()
+
+def _decode(line):
+    return line.decode("utf-8", errors="replace").replace("\r\n", "\n")
+
+PROGRESS_STEP = 1 << 20
+
+class TraceParser(object):
+    """
+    Resumable parser over a spacer.log that may still be growing.
+    Keeps the byte offset reached so far, the half-finished event and the
+    finalized events, so each update only parses the bytes appended since.
+    The log is read line by line and the exprs of the events are read back
+    from it when serializing, so memory does not grow with the log text.
+    The exprs are interned: the events with the same expr share the idx of
+    the first one as expr_ref, found by a digest of the text.
+    """
+    def __init__(self, log_path = None):
+        self.log_path = log_path
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.offset = 0
+        self.all_events = [Event(0)]
+        self.index = ParentIndex(self.all_events[0])
+        self.summary = ExpSummary()
+        #digest of an expr -> idx of the first event with it
+        self.expr_refs = {_expr_digest(""): 0}
+        self.event = Event(idx = 1)
+        #byte offsets of the header lines of self.event and of its end
+        self.line_starts = []
+        self.event_end = 0
+
+    def add_line(self, line, start = None, end = None):
+        #return the idx of the event finalized by this line, if any
         if line.strip()=="":
-            if len(event.lines)!=0: #not an empty event
-                event.finalize(all_events)
-                all_events.append(event)
-                timer+=1
-                event = Event(idx = timer)
-            
+            if len(self.event.lines)!=0: #not an empty event
+                return self.finalize_event()
         else:
-            event.add_line(line)
+            self.event.add_line(line)
+            if start is not None and len(self.line_starts) < 3:
+                self.line_starts.append(start)
+            self.event_end = end
+        return None
+
+    def finalize_event(self):
+        event = self.event
+        event.finalize(self.index)
+        self.summary.add(event, self.all_events[event.parent])
+        k = event.expr_start()
+        expr = "".join(event.lines[k:])
+        event.expr_ref = self.expr_refs.setdefault(_expr_digest(expr), event.idx)
+        if self.log_path is None:
+            event.expr = expr
+        else:
+            start = self.line_starts[k] if k < len(self.line_starts) else self.event_end
+            event.expr_span = (start, self.event_end)
+            event.expr = None
+        event.lines = None
+        self.index.add(event)
+        self.all_events.append(event)
+        self.event = Event(idx = len(self.all_events))
+        self.line_starts = []
+        return event.idx
+
+    def feed(self, lines):
+        #return the idx of the events finalized by these lines
+        new_events = []
+        for line in lines:
+            idx = self.add_line(line)
+            if idx is not None:
+                new_events.append(idx)
+        return new_events
+
+    def update(self, progress = None):
+        """
+        Parse the complete lines appended to the log since the last call.
+        progress(bytes_parsed, bytes_total) is called every PROGRESS_STEP bytes,
+        in bytes of the stored log (compressed, once the experiment is parsed).
+        The offsets are in bytes of the log itself.
+        """
+        found = find_artifact(self.log_path)
+        if found is None:
+            return []
+        stored_path, encoding = found
+        try:
+            size = os.path.getsize(stored_path)
+        except OSError:
+            return []
+        if encoding == "identity" and size < self.offset:
+            #the log was truncated or replaced, start over
+            self.reset()
+        new_events = []
+        next_progress = self.offset + PROGRESS_STEP
+        with open(stored_path, "rb") as raw, decoding(raw, encoding) as f:
+            f.seek(self.offset)
+            for line in iter(f.readline, b""):
+                if not line.endswith(b"\n"):
+                    #a partially written line is left for the next update
+                    break
+                start = self.offset
+                self.offset += len(line)
+                idx = self.add_line(_decode(line), start, self.offset)
+                if idx is not None:
+                    new_events.append(idx)
+                if progress is not None and self.offset >= next_progress:
+                    progress(raw.tell(), size)
+                    next_progress = self.offset + PROGRESS_STEP
+        return new_events
+
+    def open_log(self):
+        #no log (yet) means no expr span to read back
+        if self.log_path is None or find_artifact(self.log_path) is None:
+            return contextlib.nullcontext()
+        return open_artifact(self.log_path)
 
-    spacer_nodes = {}
-    for event in all_events:
-        spacer_nodes[event.idx] = event.to_Json()
+    def read_expr(self, event, log):
+        if event.expr_span is None:
+            return event.expr
+        start, end = event.expr_span
+        log.seek(start)
+        return _decode(log.read(end - start))
 
-    return spacer_nodes
+    def delta_ids(self, from_node = 0):
+        #idx of the nodes from from_node on, plus the older nodes whose children changed
+        changed = set()
+        for idx in range(from_node, len(self.all_events)):
+            yield idx
+            parent = self.all_events[idx].parent
+            if parent < from_node and parent not in changed:
+                changed.add(parent)
+                yield parent
 
-def save_var_rels(rel, f):
-    if (rel.name() == "simple!!query"):
-        return
-    file_line = "(declare-const {name} ({sort}))\n"
-    for i in range(rel._fdecl.arity()):
-        name = rel._mk_arg_name(i)
-        sort = str(rel._fdecl.domain(i)).replace(",", "").replace("(", " ").replace(")", "")
-        f.write(file_line.format(name=name, sort=sort))
+    def iter_nodes(self, from_node = 0, interned = False):
+        if interned:
+            #no expr to read back
+            for idx in self.delta_ids(from_node):
+                yield self.all_events[idx].to_Json(interned=True)
+            return
+        with self.open_log() as log:
+            for idx in self.delta_ids(from_node):
+                event = self.all_events[idx]
+                yield event.to_Json(self.read_expr(event, log))
 
-def parse_exp(exp_name):
+    def iter_exprs(self, from_node = 0):
+        #(expr_ref, expr) of the exprs first seen from from_node on, the ones the nodes before already sent
+        with self.open_log() as log:
+            for idx in range(from_node, len(self.all_events)):
+                event = self.all_events[idx]
+                if event.expr_ref == idx:
+                    yield idx, self.read_expr(event, log)
+
+    def nodes_since(self, from_node = 0):
+        spacer_nodes = {}
+        for node in self.iter_nodes(from_node):
+            spacer_nodes[node["nodeID"]] = node
+        return spacer_nodes
+
+    def search(self, criteria, tokens, after_node = -1):
+        """
+        idx of the events with the given attributes (criteria maps the
+        columns of the nodes table to values) whose exprs have all the
+        tokens, after after_node, in order
+        """
+        attributes = {"expr_id": "exprID", "pob_id": "pobID", "pt_name": "pt_name", "search_pt_name": "search_pt_name", "level": "level"}
+        tokens = set(tokens)
+        with self.open_log() as log:
+            for event in self.all_events[max(0, after_node + 1):]:
+                if "event_type" in criteria and str(event.event_type) != criteria["event_type"]:
+                    continue
+                if any(getattr(event, attributes[k]) != v for k, v in criteria.items() if k != "event_type"):
+                    continue
+                if tokens and not tokens <= expr_tokens(self.read_expr(event, log)):
+                    continue
+                yield event.idx
+
+    def iter_nodes_json(self, from_node = 0, interned = False):
+        #same as dumps(self.nodes_since(from_node)), one node at a time
+        yield "{"
+        sep = ""
+        for node in self.iter_nodes(from_node, interned):
+            yield '%s"%d": %s' % (sep, node["nodeID"], dumps(node).decode("utf-8"))
+            sep = ", "
+        yield "}"
+
+    def iter_exprs_json(self, from_node = 0):
+        #the exprs of iter_exprs as a JSON object expr_ref -> expr
+        yield "{"
+        sep = ""
+        for expr_ref, expr in self.iter_exprs(from_node):
+            yield '%s"%d": %s' % (sep, expr_ref, dumps(expr).decode("utf-8"))
+            sep = ", "
+        yield "}"
+
+    def iter_result_json(self, from_node = 0, interned = False):
+        #the nodes_list (and exprs when interned) of a poke result
+        yield ', "nodes_list": '
+        yield from self.iter_nodes_json(from_node, interned)
+        if interned:
+            yield ', "exprs": '
+            yield from self.iter_exprs_json(from_node)
+
+#least recently used first, at most TAIL_PARSERS of them
+_tail_parsers = OrderedDict()
+_tail_parsers_lock = threading.Lock()
+
+def get_tail_parser(exp_name, log_path):
+    with _tail_parsers_lock:
+        parser = _tail_parsers.get(exp_name)
+        if parser is not None:
+            _tail_parsers.move_to_end(exp_name)
+            return parser
+        parser = _tail_parsers[exp_name] = TraceParser(log_path)
+        while len(_tail_parsers) > TAIL_PARSERS:
+            #a request still holding it keeps using it, the next one starts a new one
+            _tail_parsers.popitem(last=False)
+        return parser
+
+def has_tail_parser(exp_name):
+    with _tail_parsers_lock:
+        return exp_name in _tail_parsers
+
+def drop_tail_parser(exp_name):
+    with _tail_parsers_lock:
+        return _tail_parsers.pop(exp_name, None)
+
+def parse(lines):
+    parser = TraceParser()
+    parser.feed(lines)
+    return parser.nodes_since(0)
+
+#symbols of an expr: variables, function and predicate names, |quoted| symbols
+token_re = re.compile(r"\|[^|]*\||(?!-[0-9])[A-Za-z_~!@$%^&*+=<>.?/\-][A-Za-z0-9_~!@$%^&*+=<>.?/\-:#']*")
+#too common to be worth indexing
+stop_tokens = frozenset(["and", "or", "not", "=>", "=", "<=", ">=", "<", ">", "+", "-", "*", "ite", "let", "true", "false"])
+
+def expr_tokens(expr):
+    return set(token_re.findall(expr or "")) - stop_tokens
+
+def save_nodes(exp_name, parser):
+    """
+    The distinct exprs in node_exprs, the nodes referring to them by
+    expr_ref and their node_tokens (the inverted index of their exprs), by
+    batches, under a new nodes key (see new_nodes_key), returned for
+    swap_nodes to put them in use. Each batch is its own transaction: the
+    exprs are read back and tokenized without holding the write lock.
+    """
+    key = new_nodes_key(exp_name)
+    exprs = parser.iter_exprs()
+    nodes = parser.iter_nodes(interned=True)
+    #tokens of each distinct expr, shared by the nodes with it
+    expr_tokens_by_ref = {}
+    while True:
+        batch = list(itertools.islice(exprs, 10000))
+        if not batch:
+            break
+        for expr_ref, expr in batch:
+            tokens = expr_tokens(expr)
+            if tokens:
+                expr_tokens_by_ref[expr_ref] = tokens
+        with transaction() as db:
+            db.executemany('INSERT INTO node_exprs(exp_name, expr_ref, expr) VALUES (?,?,?)',
+                           ((key, expr_ref, expr) for expr_ref, expr in batch))
+    while True:
+        batch = list(itertools.islice(nodes, 10000))
+        if not batch:
+            break
+        rows = [(key, node["nodeID"], node["parent"], json.dumps(node["children"]), node["event_type"],
+                 node["exprRef"], node["level"], node["exprID"], node["pobID"], node["pt_name"],
+                 parser.all_events[node["nodeID"]].search_pt_name)
+                for node in batch]
+        token_rows = [(key, token, node["nodeID"]) for node in batch
+                      for token in expr_tokens_by_ref.get(node["exprRef"], ())]
+        with transaction() as db:
+            db.executemany('INSERT INTO nodes(exp_name, node_id, parent, children, event_type, expr_ref, level, expr_id, pob_id, pt_name, search_pt_name) VALUES (?,?,?,?,?,?,?,?,?,?,?)',
+                           rows)
+            db.executemany('INSERT INTO node_tokens(exp_name, token, node_id) VALUES (?,?,?)', token_rows)
+    return key
+
+def swap_nodes(exp_name, key):
+    #the nodes save_nodes stored under key in place of the ones of the experiment, return the nodes key of those, if any
+    with transaction() as db:
+        row = db.execute('SELECT nodes_key FROM stored_nodes_key WHERE exp_name = ?', (exp_name,)).fetchone()
+        db.execute('REPLACE INTO stored_nodes_key(exp_name, nodes_key) VALUES (?,?)', (exp_name, key))
+        db.execute('REPLACE INTO node_tokens_done(exp_name) VALUES (?)', (exp_name,))
+    #serialized from the nodes replaced here
+    remove_poke_caches(exp_name)
+    return row["nodes_key"] if row is not None else None
+
+def index_stored_nodes(exp_name):
+    #node_tokens of an experiment stored before they were built with its nodes
+    with transaction() as db:
+        if db.execute('SELECT 1 FROM node_tokens_done WHERE exp_name = ?', (exp_name,)).fetchone():
+            return
+        row = db.execute('SELECT nodes_key FROM stored_nodes_key WHERE exp_name = ?', (exp_name,)).fetchone()
+        if row is None:
+            return
+        key = row["nodes_key"]
+        db.execute('DELETE FROM node_tokens WHERE exp_name = ?', (key,))
+        rows = db.execute('SELECT node_id, expr FROM nodes_with_exprs WHERE exp_name = ?', (exp_name,)).fetchall()
+        db.executemany('INSERT INTO node_tokens(exp_name, token, node_id) VALUES (?,?,?)',
+                       ((key, token, row["node_id"]) for row in rows for token in expr_tokens(row["expr"])))
+        db.execute('REPLACE INTO node_tokens_done(exp_name) VALUES (?)', (exp_name,))
+
+def save_summary(exp_name, parser):
+    insert_db('REPLACE INTO exp_summary(exp_name, summary) VALUES (?,?)',
+              (exp_name, json.dumps(parser.summary.to_Json())))
+
+def parse_exp(exp_name, from_node = None, progress = None, interned = False, spacer_state = None):
+    """
+    Parse the experiment. A running experiment is parsed incrementally:
+    only the part of spacer.log appended since the previous call is read.
+    If from_node is given while it is running, nodes_list only holds the
+    nodes from that idx on and the older nodes whose children changed;
+    next_node is the cursor for the following call. from_node = 0 in the
+    result means nodes_list is the whole tree.
+    Returns the result serialized to JSON, as an iterable of chunks. Once
+    the experiment is finished, its nodes are stored in the nodes table.
+    progress(phase, done, total) is told how far the parse is, phase being
+    "input", "trace" (done and total in bytes of spacer.log, as stored) or
+    "saving".
+    If interned, the nodes have an exprRef instead of their expr, and exprs
+    maps the expr_refs to the exprs (only the ones first seen from from_node
+    on while it is running).
+    spacer_state is the one the caller went by (see get_exp_state), else it
+    is read from stdout: a caller that took it for running does not get it
+    stored.
+    """
     exp_folder = os.path.join(MEDIA, exp_name)
-    nodes_list = []
     run_cmd = ""
     stdout = safe_read(os.path.join(exp_folder, "stdout"))
     stderr = safe_read(os.path.join(exp_folder, "stderr"))
-    spacer_log = safe_read(os.path.join(exp_folder, "spacer.log"))
     run_cmd = safe_read(os.path.join(exp_folder, "run_cmd"))[0].strip()
     temp_var_names = safe_read(os.path.join(exp_folder, "var_names")) 
     var_names = temp_var_names[0].strip() if temp_var_names != [] else ""
     expr_map = get_expr_map(exp_name)
-    rels = []
 
     status = "success"
-    spacer_state = get_spacer_state(stderr, stdout)
-    #generate var_decls
+    if spacer_state is None:
+        spacer_state = get_spacer_state(stderr, stdout)
+        if spacer_state == "running" and is_exp_done(exp_name):
+            #the job is over without an answer on stdout (e.g. it timed out)
+            spacer_state = "unknown"
+    #generate var_decls, only done once per distinct input
+    if progress is not None:
+        progress("input", 0, 0)
     try:
         print("trying to parse input")
-        new_context = z3.Context()
-        db = H.load_horn_db_from_file(os.path.join(exp_folder, "input_file.smt2"), new_context)
-        print("done load horndb")
-        for rel_name in db._rels:
-            rel = db.get_rel(rel_name)
-            rels.append(rel)
-        with open(os.path.join(exp_folder, "var_decls"), "w") as f:
-            for rel in rels:
-                save_var_rels(rel, f)
+        with metrics.timer("horndb"):
+            get_var_decls(exp_folder)
         print("done parsing input")
     except:
         traceback.print_exc()
         status = "error in loading horndb. skip parsing the file"
         print(status)
     #parse events
-    nodes_list = parse(spacer_log)
-    
+    log_path = os.path.join(exp_folder, "spacer.log")
+    if spacer_state == "running":
+        parser = get_tail_parser(exp_name, log_path)
+    else:
+        #finish the tail parser if there is one, its work is not lost
+        parser = drop_tail_parser(exp_name) or TraceParser(log_path)
+    with parser.lock:
+        with metrics.timer("parse"):
+            parser.update(None if progress is None else lambda done, total: progress("trace", done, total))
+        next_node = len(parser.all_events)
+        if from_node is None or from_node > next_node or spacer_state != "running":
+            #unknown cursor (e.g. the server restarted) or final result: send everything
+            from_node = 0
+        if spacer_state == "running":
+            #the parser is shared with the next pokes, serialize while holding it
+            with metrics.timer("serialize"):
+                nodes_list = "".join(parser.iter_result_json(from_node, interned))
+
     res = {'status': status,
            'spacer_state': spacer_state,
-           'nodes_list': nodes_list,
+           'from_node': from_node,
+           'next_node': next_node,
            'run_cmd': run_cmd,
            'var_names': var_names,
            'expr_map': expr_map}
 
-    #write to db
-    if spacer_state !="running":
-        try:
+    if spacer_state == "running":
+        return [dumps(res).decode("utf-8")[:-1], nodes_list, "}"]
+
+    #write to db: the nodes one row per node, the rest in nodes_list
+    res_json = dumps(res).decode("utf-8")
+    if progress is not None:
+        progress("saving", next_node, next_node)
+    try:
+        #the batches of save_nodes are committed as they go, only the swap holds the write lock until the end
+        key = save_nodes(exp_name, parser)
+        with transaction():
+            replaced = swap_nodes(exp_name, key)
+            save_summary(exp_name, parser)
             insert_db('REPLACE INTO nodes_list(exp_name, nodes_list) VALUES (?,?)',
-                      (exp_name, json.dumps(res)))
-        except:
-            traceback.print_exc()
+                      (exp_name, res_json))
+        #only the replaced nodes: the keys of other saves may still be written to
+        if replaced is not None and replaced != key:
+            drop_nodes_key(replaced)
+    except:
+        traceback.print_exc()
+        return [res_json[:-1]] + list(parser.iter_result_json(0, interned)) + ["}"]
 
-    return res
+    return iter_parsed_exp(exp_name, res_json, interned)
 if __name__=="__main__":
-    file_name = "/home/nv3le/workspace/saturation-visualization/deepSpacer/pobvis/app/.z3-trace" 
-    if len(sys.argv) > 1:
-        file_name = sys.argv[1]
-    with open(file_name, "r") as f:
-        lines = f.readlines()
-        all_events = parse(lines)
-        print(len(all_events))
-        # for e in all_events[:10]:
-        #     print(e.to_Node())
-
+    #python3 -m app.utils.trace_parsing spacer.log, see benchmarks/ for timings
+    if len(sys.argv) != 2:
+        print("usage: python3 -m app.utils.trace_parsing <spacer.log>")
+        sys.exit(1)
+    parser = TraceParser(sys.argv[1])
+    parser.update()
+    print(len(parser.all_events))
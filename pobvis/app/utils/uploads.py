@@ -0,0 +1,243 @@
+"""
+Resumable uploads of experiments, for the traces too big to send as
+strings in the JSON body of upload_files.
+
+    upload_start    {expName, runCmd, spacerState,
+                     files: {"spacerLog": {size, sha256, encoding}, "inputProblem": {...}}}
+                    -> upload_id
+    upload_chunk    ?uploadId=&file=&offset=, the bytes of the file from offset on as body
+                    -> received, the bytes of the file received so far
+    upload_status   {uploadId} -> received of each file, to resume an interrupted upload
+    upload_finish   {uploadId} -> exp_name, once every file is complete and matches its sha256
+
+Files are uploaded as they are: size and sha256 are those of the uploaded
+bytes, encoding (identity, gzip or zstd, see compression) how to get the
+file back from them. A chunk is appended to the part file of its file under
+UPLOADS as the body is read, it is never held in memory. upload_finish
+decompresses the parts into the folder of a new experiment, the same way,
+except for a compressed spacer.log, which is kept as it was sent (see
+ARTIFACTS in compression) once it is checked to decompress.
+Uploads left unfinished are removed after UPLOAD_EXPIRY.
+"""
+import os
+import re
+import json
+import time
+import shutil
+import hashlib
+import secrets
+import threading
+from app.utils.compression import check_encoding, open_decoded, ARTIFACTS, SUFFIXES
+from app.settings import MEDIA, UPLOADS, UPLOAD_EXPIRY, ARTIFACT_ENCODING
+
+#uploaded file -> file in the experiment folder
+upload_files = {"spacerLog": "spacer.log", "inputProblem": "input_file.smt2"}
+
+#the first line of stdout, an uploaded experiment is never running
+spacer_states = ("sat", "unsat", "unknown", "uploaded")
+
+SESSION_FILE = "session.json"
+#the folder of the experiment is put together here, in the upload folder, then moved to MEDIA
+STAGING_FOLDER = "exp"
+COPY_BUFFER = 1 << 20
+
+upload_id_re = re.compile(r"^[0-9a-f]{32}$")
+
+#one lock per upload, so that its chunks are appended one at a time
+_locks = {}
+_locks_lock = threading.Lock()
+
+class UploadError(Exception):
+    def __init__(self, status_code, message, received = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.received = received
+
+def _lock(upload_id):
+    with _locks_lock:
+        return _locks.setdefault(upload_id, threading.Lock())
+
+def _upload_folder(upload_id):
+    if not isinstance(upload_id, str) or not upload_id_re.match(upload_id):
+        raise UploadError(400, "bad upload id")
+    folder = os.path.join(UPLOADS, upload_id)
+    if not os.path.exists(os.path.join(folder, SESSION_FILE)):
+        raise UploadError(404, "no upload {}".format(upload_id))
+    return folder
+
+def _part_path(folder, name):
+    return os.path.join(folder, name + ".part")
+
+def _received(folder, name):
+    try:
+        return os.path.getsize(_part_path(folder, name))
+    except OSError:
+        return 0
+
+def load_session(upload_id):
+    folder = _upload_folder(upload_id)
+    with open(os.path.join(folder, SESSION_FILE), "r") as f:
+        return folder, json.load(f)
+
+def remove_expired(now = None):
+    now = time.time() if now is None else now
+    try:
+        upload_ids = os.listdir(UPLOADS)
+    except OSError:
+        return
+    for upload_id in upload_ids:
+        folder = os.path.join(UPLOADS, upload_id)
+        try:
+            expired = now - os.path.getmtime(folder) > UPLOAD_EXPIRY
+        except OSError:
+            continue
+        if expired:
+            shutil.rmtree(folder, ignore_errors=True)
+
+def start_upload(params):
+    """Check the description of the files and open an upload for them, return its id"""
+    files = params.get('files', {})
+    if not isinstance(files, dict) or "spacerLog" not in files:
+        raise UploadError(400, "files must describe at least spacerLog")
+    session_files = {}
+    for name, desc in files.items():
+        if name not in upload_files:
+            raise UploadError(400, "unknown file {}, expected one of {}".format(name, ", ".join(upload_files)))
+        encoding = desc.get('encoding', "identity")
+        try:
+            check_encoding(encoding)
+            size = int(desc['size'])
+            sha256 = str(desc['sha256']).lower()
+        except (KeyError, TypeError, ValueError) as e:
+            raise UploadError(400, "bad description of {}: {}".format(name, e))
+        session_files[name] = {'size': size, 'sha256': sha256, 'encoding': encoding}
+    spacer_state = params.get('spacerState', 'uploaded')
+    if spacer_state not in spacer_states:
+        raise UploadError(400, "spacerState must be one of {}".format(", ".join(spacer_states)))
+
+    remove_expired()
+    upload_id = secrets.token_hex(16)
+    folder = os.path.join(UPLOADS, upload_id)
+    os.makedirs(folder)
+    session = {'exp_name': params.get('expName', ''),
+               'run_cmd': params.get('runCmd', ''),
+               'spacer_state': spacer_state,
+               'files': session_files}
+    with open(os.path.join(folder, SESSION_FILE), "w") as f:
+        json.dump(session, f)
+    for name in session_files:
+        open(_part_path(folder, name), "wb").close()
+    return upload_id
+
+def upload_status(upload_id):
+    folder, session = load_session(upload_id)
+    return {name: {'size': desc['size'], 'received': _received(folder, name)}
+            for name, desc in session['files'].items()}
+
+def append_chunk(upload_id, name, offset, stream):
+    """
+    Append the bytes read from stream to the file, which must have offset
+    bytes so far. Return the bytes received, with what was read before the
+    stream broke off if it did.
+    """
+    folder, session = load_session(upload_id)
+    if name not in session['files']:
+        raise UploadError(400, "{} is not part of upload {}".format(name, upload_id))
+    size = session['files'][name]['size']
+    with _lock(upload_id):
+        received = _received(folder, name)
+        if offset != received:
+            #e.g. a chunk sent again after its response was lost: the client resumes from received
+            raise UploadError(409, "offset {} but {} bytes received".format(offset, received), received)
+        with open(_part_path(folder, name), "ab") as f:
+            try:
+                while True:
+                    block = stream.read(COPY_BUFFER)
+                    if not block:
+                        break
+                    if received + len(block) > size:
+                        raise UploadError(413, "more than the {} bytes of {}".format(size, name), received)
+                    f.write(block)
+                    received += len(block)
+            finally:
+                f.flush()
+                #the bytes beyond size are not kept
+                f.truncate(received)
+    os.utime(folder)
+    return received
+
+def _sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(COPY_BUFFER), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def _keep_compressed(name, encoding):
+    #the experiment is uploaded finished, its artifacts would be compressed once parsed anyway
+    return upload_files[name] in ARTIFACTS and encoding in SUFFIXES and ARTIFACT_ENCODING != "identity"
+
+def _link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+def finish_upload(upload_id, new_exp_name):
+    """
+    Check the files and decompress them into the folder of new_exp_name.
+    A file whose checksum does not match is emptied, to be sent again.
+    The folder is filled in the upload folder and renamed into MEDIA once
+    complete: the parts stay where they are until then, so a failure does
+    not lose any. Return the session.
+    """
+    folder, session = load_session(upload_id)
+    with _lock(upload_id):
+        for name, desc in session['files'].items():
+            received = _received(folder, name)
+            if received != desc['size']:
+                raise UploadError(409, "{} is incomplete: {} of {} bytes".format(name, received, desc['size']), received)
+        for name, desc in session['files'].items():
+            part = _part_path(folder, name)
+            if _sha256(part) != desc['sha256']:
+                open(part, "wb").close()
+                raise UploadError(422, "checksum of {} does not match, it has to be sent again".format(name), 0)
+
+        exp_folder = os.path.join(MEDIA, new_exp_name)
+        if os.path.exists(exp_folder):
+            #exp names are made of the time to the second
+            raise UploadError(409, "experiment {} already exists, try again".format(new_exp_name))
+        staging = os.path.join(folder, STAGING_FOLDER)
+        #left by a finish that failed
+        shutil.rmtree(staging, ignore_errors=True)
+        os.mkdir(staging)
+        for name, desc in session['files'].items():
+            part = _part_path(folder, name)
+            exp_file = os.path.join(staging, upload_files[name])
+            try:
+                if _keep_compressed(name, desc['encoding']):
+                    with open_decoded(part, desc['encoding']) as src:
+                        while src.read(COPY_BUFFER):
+                            pass
+                    _link_or_copy(part, exp_file + SUFFIXES[desc['encoding']])
+                    continue
+                with open_decoded(part, desc['encoding']) as src, open(exp_file, "wb") as dst:
+                    shutil.copyfileobj(src, dst, COPY_BUFFER)
+            except Exception as e:
+                #truncated or corrupt stream (the errors differ between gzip and zstandard)
+                shutil.rmtree(staging, ignore_errors=True)
+                raise UploadError(422, "cannot decompress {}: {}".format(name, e))
+        for name, content in (("run_cmd", session['run_cmd']), ("stdout", session['spacer_state'])):
+            with open(os.path.join(staging, name), "w") as f:
+                f.write(content)
+        try:
+            os.rename(staging, exp_folder)
+        except OSError:
+            shutil.rmtree(staging, ignore_errors=True)
+            if os.path.exists(exp_folder):
+                raise UploadError(409, "experiment {} already exists, try again".format(new_exp_name))
+            raise
+    shutil.rmtree(folder, ignore_errors=True)
+    with _locks_lock:
+        _locks.pop(upload_id, None)
+    return session
@@ -1,14 +1,20 @@
-from flask import g
 import pysmt.operators as pyopt
-import sqlite3
-from settings import DATABASE, MEDIA, options_for_visualization
+from app.utils.storage import get_db, commit, transaction
+from app.utils.compression import open_artifact
+from app.utils.responses import dumps, not_modified, etag_response
+from settings import MEDIA, NODES_PAGE_SIZE, MAX_NODES_PAGE_SIZE, MAX_EXPS_PAGE_SIZE, LOD_BUDGET, MAX_LOD_BUDGET
+import hashlib
+import bisect
+import os
+import glob
+import uuid
 import json
 from datetime import datetime
 import psutil
 
 def safe_read(file_path):
     try:
-        with open(file_path, "r") as f:
+        with open_artifact(file_path, text=True) as f:
             data = f.readlines()
             if len(data)==0:
                 return [""]
@@ -20,7 +26,7 @@ def safe_read(file_path):
 
 def get_expr_map(exp_name):
     expr_map = {}
-    expr_from_exp_name = query_db('SELECT * FROM expr_map WHERE exp_name=?',(exp_name,))
+    expr_from_exp_name = query_db('SELECT * FROM expr_map WHERE exp_name=? AND NOT deleted',(exp_name,))
     for r in expr_from_exp_name:
         expr_id = r['expr_id']
         value = json.loads(r['value'])
@@ -28,40 +34,318 @@ def get_expr_map(exp_name):
 
     return expr_map
 
+def get_expr_map_version(exp_name):
+    row = query_db('SELECT version FROM expr_map_version WHERE exp_name = ?', (exp_name,), one=True)
+    return row['version'] if row is not None else 0
+
+def get_expr_map_since(exp_name, since_version):
+    #(version, exprs changed since since_version, ids removed since since_version)
+    expr_map = {}
+    removed = []
+    for r in query_db('SELECT * FROM expr_map WHERE exp_name = ? AND version > ?', (exp_name, since_version)):
+        if r['deleted']:
+            removed.append(r['expr_id'])
+        else:
+            expr_map[r['expr_id']] = json.loads(r['value'])
+    return get_expr_map_version(exp_name), expr_map, removed
+
+def save_expr_map_delta(exp_name, changed, removed, base_version = None):
+    """
+    Write the changed and removed exprs in one transaction, as a new
+    version of the expr_map. Removed exprs are kept as deleted rows so
+    that get_expr_map_since can report them.
+    Returns (False, current version) if base_version is given and is not
+    the current version, (True, new version) otherwise.
+    """
+    with transaction() as db:
+        version = get_expr_map_version(exp_name)
+        if base_version is not None and base_version != version:
+            return False, version
+        version += 1
+        rows = [(exp_name, int(k), json.dumps(v), version, 0) for k, v in changed.items()]
+        rows.extend((exp_name, int(k), None, version, 1) for k in removed)
+        db.executemany('REPLACE INTO expr_map(exp_name, expr_id, value, version, deleted) VALUES (?,?,?,?,?)', rows)
+        db.execute('REPLACE INTO expr_map_version(exp_name, version) VALUES (?,?)', (exp_name, version))
+    return True, version
+
+def node_to_json(row, interned = False):
+    #a row of nodes_with_exprs (or of nodes, if interned) in the shape of Event.to_Json
+    node = {"nodeID": row["node_id"],
+            "parent": row["parent"],
+            "children": json.loads(row["children"]),
+            "event_type": row["event_type"],
+            "expr": row["expr"],
+            "level": row["level"],
+            "exprID": row["expr_id"],
+            "pobID": row["pob_id"],
+            "pt_name": row["pt_name"],
+            "to_be_vis": True}
+    if interned and row["expr_ref"] is not None:
+        #the nodes stored before the exprs were interned keep their expr
+        del node["expr"]
+        node["exprRef"] = row["expr_ref"]
+    return node
+
+def has_nodes(exp_name):
+    return query_db('SELECT 1 FROM stored_nodes WHERE exp_name = ? LIMIT 1', (exp_name,), one=True) is not None
+
+def iter_parsed_exp(exp_name, res_json, interned = False):
+    """
+    Serialize a parsed experiment: res_json is its nodes_list row, the
+    nodes are streamed from the nodes table. Experiments parsed before the
+    nodes table existed have the whole result in res_json.
+    If interned, the nodes have an exprRef instead of their expr and the
+    distinct exprs are sent once, in exprs (expr_ref -> expr).
+    """
+    if not has_nodes(exp_name):
+        yield res_json
+        return
+    yield res_json[:-1]
+    yield ', "nodes_list": {'
+    sep = ""
+    table = "stored_nodes" if interned else "nodes_with_exprs"
+    cur = get_db().execute('SELECT * FROM {} WHERE exp_name = ? ORDER BY node_id'.format(table), (exp_name,))
+    for row in cur:
+        yield '%s"%d": %s' % (sep, row["node_id"], dumps(node_to_json(row, interned)).decode("utf-8"))
+        sep = ", "
+    cur.close()
+    yield "}"
+    if interned:
+        yield ', "exprs": {'
+        sep = ""
+        cur = get_db().execute('SELECT expr_ref, expr FROM stored_node_exprs WHERE exp_name = ? ORDER BY expr_ref', (exp_name,))
+        for row in cur:
+            yield '%s"%d": %s' % (sep, row["expr_ref"], dumps(row["expr"]).decode("utf-8"))
+            sep = ", "
+        cur.close()
+        yield "}"
+    yield "}"
+
+def nodes_page_size(page_size):
+    if page_size is None:
+        return NODES_PAGE_SIZE
+    return max(1, min(int(page_size), MAX_NODES_PAGE_SIZE))
+
+def fetch_nodes_page(query, args, after_node, page_size):
+    """
+    One page of nodes. query selects rows of nodes and must end with a
+    condition on node_id, which is completed here for keyset paging.
+    """
+    page_size = nodes_page_size(page_size)
+    rows = query_db(query + ' > ? ORDER BY node_id LIMIT ?', tuple(args) + (after_node, page_size))
+    nodes_list = {}
+    for row in rows:
+        nodes_list[row["node_id"]] = node_to_json(row)
+    #cursor for the next page, None when this was the last one
+    next_node = rows[-1]["node_id"] if len(rows) == page_size else None
+    return dumps({'status': "success", 'nodes_list': nodes_list, 'next_node': next_node})
+
+def fetch_stored_nodes(exp_name, node_ids):
+    #the given nodes of a stored experiment, in node_id order
+    node_ids = sorted(node_ids)
+    nodes = []
+    for i in range(0, len(node_ids), 500):
+        chunk = node_ids[i:i + 500]
+        rows = query_db('SELECT * FROM nodes_with_exprs WHERE exp_name = ? AND node_id IN ({}) ORDER BY node_id'.format(",".join("?" * len(chunk))),
+                        (exp_name,) + tuple(chunk))
+        nodes.extend(node_to_json(row) for row in rows)
+    return nodes
+
+def fetch_nodes_page_by_id(exp_name, node_ids, after_node, page_size):
+    """
+    One page of the given nodes (node_ids sorted) of a stored experiment,
+    paged like fetch_nodes_page.
+    """
+    page_size = nodes_page_size(page_size)
+    start = bisect.bisect_right(node_ids, after_node)
+    page = node_ids[start:start + page_size]
+    nodes_list = {node["nodeID"]: node for node in fetch_stored_nodes(exp_name, page)}
+    next_node = page[-1] if len(page) == page_size else None
+    return dumps({'status': "success", 'nodes_list': nodes_list, 'next_node': next_node})
+
+def load_parents(exp_name):
+    #the parent column of a stored experiment, in node_id order
+    cur = get_db().cursor()
+    #plain tuples, there is one row per node
+    cur.row_factory = None
+    parents = [row[0] for row in cur.execute("SELECT parent FROM stored_nodes WHERE exp_name = ? ORDER BY node_id", (exp_name,))]
+    cur.close()
+    return parents
+
+def lod_budget(budget):
+    if budget is None:
+        return LOD_BUDGET
+    return max(1, min(int(budget), MAX_LOD_BUDGET))
+
+def search_stored_nodes(exp_name, criteria, tokens, after_node, page_size):
+    """
+    One page of the node ids of a stored experiment with the given columns
+    (criteria) whose exprs have all the tokens, see node_tokens.
+    """
+    page_size = nodes_page_size(page_size)
+    query = 'SELECT node_id FROM stored_nodes WHERE exp_name = ?'
+    args = [exp_name]
+    for column, value in sorted(criteria.items()):
+        query += ' AND {} = ?'.format(column)
+        args.append(value)
+    for token in tokens:
+        query += ' AND node_id IN (SELECT node_id FROM stored_node_tokens WHERE exp_name = ? AND token = ?)'
+        args.extend((exp_name, token))
+    rows = query_db(query + ' AND node_id > ? ORDER BY node_id LIMIT ?', tuple(args) + (after_node, page_size))
+    node_ids = [row["node_id"] for row in rows]
+    next_node = node_ids[-1] if len(node_ids) == page_size else None
+    return dumps({'status': "success", 'node_ids': node_ids, 'next_node': next_node})
+
+def is_exp_done(exp_name):
+    exp = query_db('SELECT done FROM exp WHERE exp_name = ?', (exp_name,), one=True)
+    return exp is not None and bool(exp['done'])
+
+def get_exp_state(exp_name):
+    #the spacer_state of the experiment, without parsing it
+    if not exp_name or not os.path.isdir(os.path.join(MEDIA, exp_name)):
+        #no folder (a bogus name, or deleted): nothing runs, nor gets a tail parser
+        return "unknown"
+    stdout_path = os.path.join(MEDIA, exp_name, "stdout")
+    #a queued job has no stdout yet, only its first line matters to get_spacer_state
+    stdout = safe_read(stdout_path) if os.path.exists(stdout_path) else [""]
+    state = get_spacer_state([""], stdout)
+    if state == "running" and is_exp_done(exp_name):
+        #the job is over without an answer on stdout (e.g. it timed out)
+        state = "unknown"
+    return state
+
 def get_spacer_instance(exp_name):
     return {"Id": exp_name, "Lemmas": get_expr_map(exp_name)}
 
-def get_db():
-    db = getattr(g, '_database', None)
-    if db is None:
-        db = g._database = sqlite3.connect(DATABASE)
-    db.row_factory = sqlite3.Row
-    return db
-
 def query_db(query, args=(), one=False):
     cur = get_db().execute(query, args)
     rv = cur.fetchall()
     cur.close()
     return (rv[0] if rv else None) if one else rv
 def insert_db(query, args=(), one=False):
+    #committed right away, unless inside a transaction() block
     cur = get_db().execute(query, args)
-    get_db().commit()
     cur.close()
+    commit()
 
 def delete_db(query, args=(), one=False):
     cur = get_db().execute(query, args)
-    get_db().commit()
     cur.close()
+    commit()
 
+#the tables with rows of an experiment, besides exp and the node tables
+exp_tables = ("nodes_list", "stored_nodes_key", "node_tokens_done",
+              "exp_summary", "expr_map", "expr_map_version")
+#the tables with the rows of a parse under its nodes_key, with the columns of their primary key after exp_name
+node_tables = {"nodes": "node_id", "node_exprs": "expr_ref", "node_tokens": "token, node_id"}
 
-def fetch_exps():
-    exps_list = []
-    for exp in query_db('select * from exp'):
-        r = {}
-        for k in exp.keys():
-            r[k] = exp[k]
-        exps_list.append(r)
-    return json.dumps({'status': "success", 'exps_list':exps_list})
+def new_nodes_key(exp_name):
+    #the exp_name of the rows of a new parse in node_tables, no experiment has a "/" in its name (a folder of MEDIA)
+    return "{}/{}".format(exp_name, uuid.uuid4().hex)
+
+def nodes_keys(exp_name):
+    #the nodes keys with rows of the experiment: its name for the rows stored before nodes keys, then its new_nodes_key ones
+    keys = set()
+    for table in node_tables:
+        keys.update(row[0] for row in get_db().execute('SELECT DISTINCT exp_name FROM {} WHERE exp_name = ? OR (exp_name > ? AND exp_name < ?)'.format(table),
+                                                        (exp_name, exp_name + "/", exp_name + "0")))
+    return keys
+
+def drop_nodes_key(key):
+    #delete the rows under a nodes key in node_tables, by batches: each is its own short transaction
+    for table, key_columns in node_tables.items():
+        while True:
+            with transaction() as db:
+                deleted = db.execute('DELETE FROM {0} WHERE exp_name = ? AND ({1}) IN (SELECT {1} FROM {0} WHERE exp_name = ? LIMIT 10000)'.format(table, key_columns),
+                                     (key, key)).rowcount
+            if deleted == 0:
+                break
+
+def delete_exp_rows(exp_name):
+    #the experiment and everything stored about it
+    with transaction() as db:
+        db.execute("DELETE FROM exp WHERE exp_name = ?", (exp_name,))
+        for table in exp_tables:
+            db.execute("DELETE FROM {} WHERE exp_name = ?".format(table), (exp_name,))
+    #out of sight once stored_nodes_key is gone, with the ones of saves that did not get to swap_nodes
+    for key in nodes_keys(exp_name):
+        drop_nodes_key(key)
+    remove_poke_caches(exp_name)
+
+def poke_cache_path(exp_name, tag):
+    #the serialized poke result of a stored experiment, see stored_poke in main
+    return os.path.join(MEDIA, exp_name, "poke-{}.json.gz".format(tag))
+
+def remove_poke_caches(exp_name, keep = None):
+    #the serialized poke results of the experiment, but the ones whose tag starts with keep
+    for path in glob.glob(poke_cache_path(glob.escape(exp_name), "*")):
+        if keep is not None and os.path.basename(path).startswith("poke-" + keep):
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def exp_to_json(row):
+    return {k: row[k] for k in row.keys() if k not in ("rowid", "exp_id")}
+
+def fetch_exps(params = None):
+    """
+    The experiments, filtered by state and namePrefix.
+
+    pageSize and afterRow page through them in creation order (next_row is
+    the cursor of the next page). With sinceVersion, only the rows inserted
+    or updated after that version are returned, in version order (next_version
+    is the cursor of the next page), and removed lists the experiments deleted
+    since or that no longer match the filters. version is the version of the
+    whole exp table to poll from next time, and the ETag of the response.
+    """
+    params = params or {}
+    version = query_db('SELECT version FROM exp_version', one=True)["version"]
+    query_key = json.dumps(params, sort_keys=True).encode('utf-8')
+    etag = "exps-{}-{}".format(version, hashlib.sha1(query_key).hexdigest()[:16])
+    if not_modified(etag):
+        #nothing changed since the client got this answer
+        return etag_response(b"", etag)
+
+    states = params.get('state')
+    if isinstance(states, str):
+        states = [states]
+    name_prefix = params.get('namePrefix', '')
+    def matches(row):
+        return (not states or row["state"] in states) and row["exp_name"].startswith(name_prefix)
+
+    page_size = params.get('pageSize')
+    limit = -1 if page_size is None else max(1, min(int(page_size), MAX_EXPS_PAGE_SIZE))
+    since_version = params.get('sinceVersion')
+    res = {'status': "success", 'version': version}
+    if since_version is None:
+        conditions, args = ['exp_id > ?'], [params.get('afterRow', 0)]
+        if states:
+            conditions.append('state IN ({})'.format(','.join('?' * len(states))))
+            args.extend(states)
+        if name_prefix:
+            conditions.append('substr(exp_name, 1, ?) = ?')
+            args.extend((len(name_prefix), name_prefix))
+        rows = query_db('SELECT * FROM exp WHERE {} ORDER BY exp_id LIMIT ?'.format(' AND '.join(conditions)),
+                        tuple(args) + (limit,))
+        res['exps_list'] = [exp_to_json(row) for row in rows]
+        if page_size is not None:
+            res['next_row'] = rows[-1]["exp_id"] if len(rows) == limit else None
+    else:
+        #the filters are applied here, so that rows leaving them are reported as removed
+        rows = query_db('SELECT * FROM exp WHERE row_version > ? ORDER BY row_version LIMIT ?', (since_version, limit))
+        res['exps_list'] = [exp_to_json(row) for row in rows if matches(row)]
+        removed = [row["exp_name"] for row in rows if not matches(row)]
+        #the client applies removed first, an experiment deleted then created again is in both
+        removed.extend(row["exp_name"] for row in
+                       query_db('SELECT exp_name FROM exp_tombstones WHERE row_version > ? ORDER BY row_version', (since_version,))
+                       if row["exp_name"].startswith(name_prefix))
+        res['removed'] = removed
+        if page_size is not None:
+            res['next_version'] = rows[-1]["row_version"] if len(rows) == limit else None
+    return etag_response(dumps(res), etag)
 
 def fetch_progs():
     # request_params = request.get_json()
@@ -72,7 +356,9 @@ def fetch_progs():
         for k in prog.keys():
             r[k] = prog[k]
         progs_list.append(r)
-    return json.dumps({'status': "success", 'progs_list':progs_list})
+    body = dumps({'status': "success", 'progs_list':progs_list})
+    #learned_programs has no version, the ETag is the digest of the content
+    return etag_response(body, "progs-" + hashlib.sha1(body).hexdigest())
 
 
 def get_new_exp_name(exp_name):
@@ -85,7 +371,10 @@ def calculate_val(node):
         frac = node._content.payload
         val = frac.numerator / frac.denominator
         return round(val, 4)
-    return str(node._content.payload[0])
+    if node.is_symbol():
+        return str(node._content.payload[0])
+    #int and bool constants have the value itself as payload
+    return str(node._content.payload)
 
 def to_json(node, debug = False):
     if debug: print(node, node.get_type(), node.args())
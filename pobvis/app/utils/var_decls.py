@@ -0,0 +1,112 @@
+"""
+Declarations of the variables of an input problem, as sent to PROSE.
+
+Loading the input through chctools is slow, so the declarations are
+computed once per distinct input: they are cached on disk under the sha256
+of input_file.smt2, shared by all the experiments on the same benchmark,
+and the hot ones are kept in an in-process LRU.
+"""
+import os
+import io
+import hashlib
+import threading
+import functools
+from collections import OrderedDict
+import z3
+from chctools import horndb as H
+from app.settings import DECLS_CACHE, DECLS_CACHE_SIZE
+
+_decls_lru = OrderedDict()
+_decls_lru_lock = threading.Lock()
+
+def save_var_rels(rel, f):
+    if (rel.name() == "simple!!query"):
+        return
+    file_line = "(declare-const {name} ({sort}))\n"
+    for i in range(rel._fdecl.arity()):
+        name = rel._mk_arg_name(i)
+        sort = str(rel._fdecl.domain(i)).replace(",", "").replace("(", " ").replace(")", "")
+        f.write(file_line.format(name=name, sort=sort))
+
+def load_var_decls(input_path):
+    #the content of var_decls for this input
+    new_context = z3.Context()
+    db = H.load_horn_db_from_file(input_path, new_context)
+    print("done load horndb")
+    f = io.StringIO()
+    for rel_name in db._rels:
+        save_var_rels(db.get_rel(rel_name), f)
+    return f.getvalue()
+
+@functools.lru_cache(maxsize=1024)
+def _file_digest(path, mtime_ns, size):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def input_digest(exp_folder):
+    #sha256 of the input of the experiment, only recomputed when the file changes
+    path = os.path.join(exp_folder, "input_file.smt2")
+    st = os.stat(path)
+    return _file_digest(path, st.st_mtime_ns, st.st_size)
+
+def _lru_get(digest):
+    with _decls_lru_lock:
+        if digest not in _decls_lru:
+            return None
+        _decls_lru.move_to_end(digest)
+        return _decls_lru[digest]
+
+def _lru_put(digest, decls):
+    with _decls_lru_lock:
+        _decls_lru[digest] = decls
+        _decls_lru.move_to_end(digest)
+        while len(_decls_lru) > DECLS_CACHE_SIZE:
+            _decls_lru.popitem(last=False)
+
+def get_var_decls(exp_folder):
+    """
+    The var_decls of the experiment. Raises if its input cannot be loaded;
+    failures are remembered in process so a running experiment does not
+    retry loading a broken input on every poke.
+    """
+    digest = input_digest(exp_folder)
+    decls = _lru_get(digest)
+    if decls is None:
+        cache_file = os.path.join(DECLS_CACHE, digest)
+        if os.path.exists(cache_file):
+            with open(cache_file, "r") as f:
+                decls = f.read()
+        else:
+            try:
+                decls = load_var_decls(os.path.join(exp_folder, "input_file.smt2"))
+            except Exception as e:
+                decls = e
+            else:
+                os.makedirs(DECLS_CACHE, exist_ok=True)
+                #per thread too, two requests may compute the same decls at once
+                tmp_file = "{}.{}.{}.tmp".format(cache_file, os.getpid(), threading.get_ident())
+                with open(tmp_file, "w") as f:
+                    f.write(decls)
+                os.replace(tmp_file, cache_file)
+        _lru_put(digest, decls)
+    if isinstance(decls, Exception):
+        raise ValueError("cannot load the input of {}: {}".format(exp_folder, decls))
+
+    #var_decls is kept next to the experiment, but only written once
+    var_decls_file = os.path.join(exp_folder, "var_decls")
+    if not os.path.exists(var_decls_file):
+        with open(var_decls_file, "w") as f:
+            f.write(decls)
+    return decls
+
+def get_declare_statements(exp_folder):
+    try:
+        decls = get_var_decls(exp_folder)
+    except (OSError, ValueError):
+        #e.g. an uploaded experiment whose var_decls was written elsewhere
+        with open(os.path.join(exp_folder, "var_decls"), "r") as f:
+            decls = f.read()
+    return "\n".join(line.strip() for line in decls.splitlines())
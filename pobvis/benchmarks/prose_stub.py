@@ -0,0 +1,61 @@
+"""
+Stand-in for SpacerProseBackend, to exercise the PROSE client without the
+real service. It learns one dummy program and applies programs by
+returning the lemmas unchanged, keyed by their id.
+
+    python3 -m benchmarks.prose_stub --port 2000 --delay 0.05
+
+then start the backend with PROSE_BASE_URL=http://localhost:2000/api/v1/
+"""
+import json
+import time
+import argparse
+import threading
+from flask import Flask, request, jsonify
+from werkzeug.serving import make_server
+
+def create_app(delay = 0.0):
+    stub = Flask(__name__)
+    stub.config["calls"] = {}
+    lock = threading.Lock()
+
+    def _count(name, lemmas = 0):
+        with lock:
+            calls = stub.config["calls"].setdefault(name, {"requests": 0, "lemmas": 0})
+            calls["requests"] += 1
+            calls["lemmas"] += lemmas
+        if delay:
+            time.sleep(delay)
+
+    @stub.route('/api/v1/transformations/learntransformation', methods=['POST'])
+    def learn():
+        body = request.get_json()
+        _count("learntransformation")
+        return jsonify([{"humanReadableAst": "stub program for {}".format(body.get("instance", "")),
+                         "xmlAst": "<stub/>"}])
+
+    @stub.route('/api/v1/transformations/<name>', methods=['POST'])
+    def apply(name):
+        body = request.get_json()
+        lemmas = json.loads(body["spacerInstance"])["Lemmas"]
+        _count(name, len(lemmas))
+        return jsonify(lemmas)
+
+    @stub.route('/stats', methods=['GET'])
+    def stats():
+        return jsonify(stub.config["calls"])
+
+    return stub
+
+def serve_in_thread(port = 0, delay = 0.0):
+    """Start the stub in a daemon thread, return (server, base_url)"""
+    server = make_server("127.0.0.1", port, create_app(delay), threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, "http://127.0.0.1:{}/api/v1/".format(server.server_port)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a stub PROSE backend')
+    parser.add_argument("--port", type=int, default=2000)
+    parser.add_argument("--delay", type=float, default=0.0, help="seconds added to each response")
+    args = parser.parse_args()
+    create_app(args.delay).run(host='0.0.0.0', port=args.port, threaded=True)
@@ -0,0 +1,250 @@
+"""
+Timings of the hot paths of the backend, on synthetic traces (trace_gen).
+
+For each trace size:
+    parse            TraceParser over spacer.log, as poke does
+    find_parent      the parent search of every event, on its own
+    to_Json          the nodes as dicts, with their exprs read back from the log
+    serialize        the nodes_list JSON sent by poke
+and end to end, through the Flask test client with a stub PROSE server:
+    poke_finished    first poke of a finished experiment, until it is parsed
+    poke_stored      poke of the same experiment, from the db (and with internExprs)
+    poke_running     first poke of a running experiment, then a poke with its cursor
+    save_exprs       a whole expr_map with every lemma, then a delta of 10 exprs
+    get_exprs        the whole expr_map
+    fetch_exps       every experiment, a page of 50, a poll answered with 304
+    apply_multi_transformation   200 lemmas, cold then cached
+
+The report is JSON: meta (commit, python, arguments) and one entry per
+(size, case) with the best and all the times in seconds. With --baseline,
+the cases slower than in the baseline report by more than --threshold are
+listed and the exit code is 1. A case that raises or gets a response with
+an unexpected status code is reported with its error instead of times
+(and listed as failed with --baseline, if the baseline has times for it).
+
+    PYTHONPATH=.:app python3 -m benchmarks.run --sizes 1000,10000,100000 -o report.json
+
+Run from pobvis/, like the server is run from app/: the parse workers and
+the settings need the same PYTHONPATH. Sizes above 100000 are timed once.
+"""
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import argparse
+import subprocess
+import contextlib
+from benchmarks import trace_gen, prose_stub
+
+def best_of(fn, repeat):
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        runs.append(time.perf_counter() - start)
+    return {"seconds": min(runs), "runs": runs}
+
+def _commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def bench_parsing(log_path, repeat):
+    from app.utils.trace_parsing import TraceParser, ParentIndex, EType
+    results = {}
+    parser = None
+    def parse():
+        nonlocal parser
+        parser = TraceParser(log_path)
+        parser.update()
+    results["parse"] = best_of(parse, repeat)
+    events = parser.all_events
+    def find_parent():
+        index = ParentIndex(events[0])
+        for event in events[1:]:
+            event.find_parent(index)
+            index.add(event)
+    results["find_parent"] = best_of(find_parent, repeat)
+    results["to_Json"] = best_of(lambda: list(parser.iter_nodes()), repeat)
+    results["serialize"] = best_of(lambda: "".join(parser.iter_nodes_json()), repeat)
+    lemmas = {}
+    with parser.open_log() as log:
+        for event in events:
+            if event.event_type == EType.ADD_LEM:
+                lemmas[str(event.exprID)] = {"raw": parser.read_expr(event, log)}
+    return results, lemmas
+
+def _make_exp(media, exp_name, log_path, stdout):
+    exp_folder = os.path.join(media, exp_name)
+    shutil.rmtree(exp_folder, ignore_errors=True)
+    os.makedirs(exp_folder)
+    shutil.copy(log_path, os.path.join(exp_folder, "spacer.log"))
+    for name, content in (("stdout", stdout), ("stderr", ""), ("run_cmd", "z3 input_file.smt2"), ("var_names", "")):
+        with open(os.path.join(exp_folder, name), "w") as f:
+            f.write(content)
+    with open(os.path.join(exp_folder, "input_file.smt2"), "w") as f:
+        trace_gen.write_input(f)
+
+class UnexpectedStatus(Exception):
+    pass
+
+def expect(response, statuses = (200,)):
+    #a run answered with an error is a failed case, not a timing
+    if response.status_code not in statuses:
+        raise UnexpectedStatus("status {}: {}".format(response.status_code, response.get_data()[:200]))
+    return response
+
+def bench_endpoints(main, n, log_path, lemmas, repeat):
+    from app.utils.utils import insert_db, delete_db
+    client = main.app.test_client()
+    post = lambda path, body, statuses = (200,), **kwargs: expect(client.post(path, json=body, **kwargs), statuses)
+    results = {}
+
+    def case(name, fn, runs = repeat):
+        try:
+            results[name] = best_of(fn, runs)
+        except Exception as e:
+            results[name] = {"error": repr(e)}
+
+    finished, running = "bench_{}".format(n), "bench_{}_running".format(n)
+    with main.app.app_context():
+        for exp_name, done in ((finished, 1), (running, 0)):
+            delete_db("DELETE FROM exp WHERE exp_name = ?", (exp_name,))
+            delete_db("DELETE FROM nodes_list WHERE exp_name = ?", (exp_name,))
+            insert_db("INSERT INTO exp(exp_name, done, result, time, aux, state) VALUES (?,?,?,?,?,?)",
+                      (exp_name, done, "unsat" if done else "UNK", 0, "", "done" if done else "running"))
+    _make_exp(main.MEDIA, finished, log_path, "unsat\n")
+    _make_exp(main.MEDIA, running, log_path, "")
+
+    def poke_finished():
+        while post('/spacer/poke', {'expName': finished}, (200, 202)).status_code == 202:
+            time.sleep(0.05)
+    #once parsed it is stored, there is only one first poke
+    case("poke_finished", poke_finished, 1)
+    case("poke_stored", lambda: post('/spacer/poke', {'expName': finished}).data)
+    case("poke_stored_interned", lambda: post('/spacer/poke', {'expName': finished, 'internExprs': True}).data)
+    next_node = []
+    def poke_running():
+        next_node.append(json.loads(post('/spacer/poke', {'expName': running}).data)["next_node"])
+    case("poke_running", poke_running, 1)
+    case("poke_running_delta", lambda: post('/spacer/poke', {'expName': running, 'fromNode': next_node[-1]}).data)
+
+    version = []
+    def save_all():
+        version.append(json.loads(post('/spacer/save_exprs', {'expName': finished, 'changed': lemmas}).data)["version"])
+    case("save_exprs", save_all)
+    some = dict(list(lemmas.items())[:10])
+    def save_delta():
+        res = json.loads(post('/spacer/save_exprs', {'expName': finished, 'changed': some, 'version': version[-1]}).data)
+        version.append(res["version"])
+    case("save_exprs_delta", save_delta)
+    case("get_exprs", lambda: post('/spacer/get_exprs', {'expName': finished}).data)
+
+    case("fetch_exps", lambda: post('/spacer/fetch_exps', {}).data)
+    case("fetch_exps_page", lambda: post('/spacer/fetch_exps', {'namePrefix': 'bench', 'pageSize': 50}).data)
+    etag = post('/spacer/fetch_exps', {}).headers.get('ETag')
+    case("fetch_exps_304", lambda: post('/spacer/fetch_exps', {}, (304,), headers={'If-None-Match': etag}))
+
+    few = dict(list(lemmas.items())[:200])
+    body = {'expName': finished, 'lemmas': few, 'selectedProgram': 'bench program {}'.format(time.time())}
+    case("apply_multi_transformation", lambda: post('/spacer/apply_multi_transformation', body).data, 1)
+    case("apply_multi_transformation_cached", lambda: post('/spacer/apply_multi_transformation', body).data)
+    return results
+
+def _add_exps(main, count):
+    #experiments for fetch_exps to list
+    from app.utils.storage import transaction
+    with main.app.app_context():
+        with transaction() as db:
+            db.executemany("INSERT INTO exp(exp_name, done, result, time, aux, state) VALUES (?,?,?,?,?,?)",
+                           (("filler_{}".format(i), 1, "sat", i, "", "done") for i in range(count)))
+
+def compare(report, baseline, threshold):
+    """(slower, failed): the cases slower than in baseline and the ones that failed but have times there"""
+    old = {(r["size"], r["case"]): r for r in baseline["results"] if "seconds" in r}
+    slower, failed = [], []
+    for r in report["results"]:
+        base = old.get((r["size"], r["case"]))
+        if base is None:
+            continue
+        if "seconds" not in r:
+            failed.append((r["size"], r["case"], r.get("error")))
+        elif r["seconds"] > base["seconds"] * (1 + threshold):
+            slower.append((r["size"], r["case"], base["seconds"], r["seconds"]))
+    return slower, failed
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the backend on synthetic traces')
+    parser.add_argument("--sizes", default="1000,10000,100000", help="comma separated numbers of events")
+    parser.add_argument("--levels", type=int, default=None)
+    parser.add_argument("--max-depth", type=int, default=8)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--exps", type=int, default=1000, help="experiments listed by fetch_exps")
+    parser.add_argument("--no-endpoints", action="store_true", help="only time the parsing")
+    parser.add_argument("--z3", default="z3")
+    parser.add_argument("--baseline", default=None, help="report to compare with")
+    parser.add_argument("--threshold", type=float, default=0.2)
+    parser.add_argument("-o", "--output", default="-")
+    args = parser.parse_args()
+    sizes = [int(s) for s in args.sizes.split(",")]
+
+    work_dir = tempfile.mkdtemp(prefix="spacer_bench_")
+    #settings are read when the app is imported
+    os.environ["BACKEND_DATA_PATH"] = work_dir
+    os.makedirs(os.path.join(work_dir, "media"))
+    stub, prose_url = prose_stub.serve_in_thread()
+    os.environ["PROSE_BASE_URL"] = prose_url
+    app_main = None
+    #the settings print where they point to, keep them out of the report
+    with contextlib.redirect_stdout(io.StringIO()):
+        import app.utils.trace_parsing
+        if not args.no_endpoints:
+            argv, sys.argv = sys.argv, [sys.argv[0], "-z3", args.z3]
+            import app.main as app_main
+            sys.argv = argv
+            _add_exps(app_main, args.exps)
+
+    report = {"meta": {"commit": _commit(), "python": platform.python_version(), "platform": platform.platform(),
+                       "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "args": vars(args)},
+              "results": []}
+    try:
+        for n in sizes:
+            repeat = args.repeat if n <= 100000 else 1
+            log_path = os.path.join(work_dir, "trace_{}.log".format(n))
+            with open(log_path, "w") as f:
+                trace_gen.generate(f, n, args.levels, args.max_depth)
+            results, lemmas = bench_parsing(log_path, repeat)
+            if app_main is not None:
+                #the endpoints print a lot, it is not part of the report
+                with contextlib.redirect_stdout(io.StringIO()):
+                    results.update(bench_endpoints(app_main, n, log_path, lemmas, repeat))
+            for case, timing in results.items():
+                report["results"].append(dict(timing, size=n, case=case))
+                print("{:>9} {:<36} {}".format(n, case, timing.get("seconds", timing.get("error"))), file=sys.stderr)
+    finally:
+        stub.shutdown()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report_json = json.dumps(report, indent=1)
+    if args.output == "-":
+        print(report_json)
+    else:
+        with open(args.output, "w") as f:
+            f.write(report_json)
+    if args.baseline is not None:
+        with open(args.baseline, "r") as f:
+            slower, failed = compare(report, json.load(f), args.threshold)
+        for size, case, before, after in slower:
+            print("slower: {} {} {:.4f}s -> {:.4f}s".format(size, case, before, after), file=sys.stderr)
+        for size, case, error in failed:
+            print("failed: {} {} {}".format(size, case, error), file=sys.stderr)
+        if slower or failed:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+"""
+Synthetic spacer.log traces, in the format trace_parsing reads.
+
+Spacer works level by level: at level k it expands a pob at level k and
+goes down to its predecessors (level k - 1, depth + 1, ...) until it can
+block one with a lemma, then backs up and retries; once the level is done
+it propagates the lemmas to the next level. The generated trace follows
+that shape, with the number of levels, the maximal depth of a descent and
+the size of the exprs as parameters.
+
+    python3 -m benchmarks.trace_gen --events 100000 --levels 40 --max-depth 8 -o spacer.log
+"""
+import sys
+import math
+import random
+import argparse
+
+def _expr(rng, n_vars, size):
+    #a conjunction of bounds over the variables, printed over several lines like z3 does
+    atoms = []
+    for _ in range(size):
+        v = rng.randrange(n_vars)
+        op = rng.choice(("<=", ">=", "="))
+        atoms.append("({} x{} {})".format(op, v, rng.randint(-100, 100)))
+    if len(atoms) == 1:
+        return atoms[0]
+    return "(and " + "\n     ".join(atoms) + ")"
+
+def generate(out, events, levels = None, max_depth = 8, preds = 4, n_vars = 4,
+             max_expr_size = 6, lemma_prob = 0.4, seed = 0):
+    """
+    Write a trace of exactly events events to out (a text file), return the
+    number of events written. levels defaults to about sqrt(events) / 3
+    (from 2 to 200).
+    """
+    rng = random.Random(seed)
+    if levels is None:
+        levels = max(2, min(200, int(math.sqrt(events) / 3)))
+    per_level = max(1, events // levels)
+    written = 0
+    expr_id = 0
+    buf = []
+
+    def emit(text):
+        nonlocal written
+        buf.append(text)
+        buf.append("\n\n")
+        written += 1
+        if len(buf) >= 4096:
+            out.write("".join(buf))
+            buf.clear()
+
+    def new_expr_id():
+        nonlocal expr_id
+        expr_id += 1
+        return expr_id
+
+    for level in range(levels):
+        if written >= events:
+            break
+        emit("* LEVEL {}".format(level))
+        #the last level takes what is left
+        budget = events if level == levels - 1 else min(events, written + per_level)
+        lemmas = []
+        while written < budget - 1:
+            #one descent from a pob at this level
+            stack = []
+            pob_level, depth = level, 0
+            parent_pob = None
+            while written < budget - 1:
+                pob = new_expr_id()
+                emit("** expand-pob: P{} level: {} depth: {} exprID: {} pobID: {}\n{}".format(
+                    rng.randrange(preds), pob_level, depth, pob,
+                    "none" if parent_pob is None else parent_pob,
+                    _expr(rng, n_vars, rng.randint(1, max_expr_size))))
+                stack.append(pob)
+                if pob_level == 0 or depth >= max_depth or rng.random() < lemma_prob:
+                    break
+                parent_pob = pob
+                pob_level, depth = pob_level - 1, depth + 1
+            #block the deepest pob, sometimes a few more on the way back up
+            while stack and written < budget - 1:
+                pob = stack.pop()
+                lemma_level = "oo" if rng.random() < 0.1 else str(level)
+                lemma = new_expr_id()
+                emit("** add-lemma: {} exprID: {} pobID: {}\nP{}\n{}".format(
+                    lemma_level, lemma, pob, rng.randrange(preds),
+                    _expr(rng, n_vars, rng.randint(1, max_expr_size))))
+                lemmas.append(lemma)
+                if rng.random() < 0.5:
+                    break
+        if written < budget and level < levels - 1:
+            emit("Propagating to level {}".format(level + 1))
+            #the lemmas pushed to the next level
+            for lemma in rng.sample(lemmas, min(len(lemmas), max(1, per_level // 10))):
+                if written >= events:
+                    break
+                emit("** add-lemma: {} exprID: {} pobID: {}\nP{}\n{}".format(
+                    level + 1, new_expr_id(), lemma, rng.randrange(preds),
+                    _expr(rng, n_vars, rng.randint(1, max_expr_size))))
+    while written < events:
+        #levels ran out before the events did
+        emit("Propagating to level {}".format(levels))
+    out.write("".join(buf))
+    return written
+
+def write_input(out, preds = 4, n_vars = 4):
+    #a small CHC problem declaring the predicates the trace uses
+    out.write("(set-logic HORN)\n")
+    args = " ".join("Int" for _ in range(n_vars))
+    names = " ".join("x{}".format(v) for v in range(n_vars))
+    binders = " ".join("(x{} Int)".format(v) for v in range(n_vars))
+    for p in range(preds):
+        out.write("(declare-fun P{} ({}) Bool)\n".format(p, args))
+    out.write("(assert (forall ({}) (=> (= x0 0) (P0 {}))))\n".format(binders, names))
+    for p in range(1, preds):
+        out.write("(assert (forall ({}) (=> (P{} {}) (P{} {}))))\n".format(binders, p - 1, names, p, names))
+    out.write("(assert (forall ({}) (=> (and (P{} {}) (< x0 0)) false)))\n".format(binders, preds - 1, names))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate a synthetic spacer.log')
+    parser.add_argument("--events", type=int, default=10000)
+    parser.add_argument("--levels", type=int, default=None)
+    parser.add_argument("--max-depth", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-o", "--output", default="-")
+    args = parser.parse_args()
+    if args.output == "-":
+        generate(sys.stdout, args.events, args.levels, args.max_depth, seed=args.seed)
+    else:
+        with open(args.output, "w") as f:
+            generate(f, args.events, args.levels, args.max_depth, seed=args.seed)
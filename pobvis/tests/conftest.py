@@ -0,0 +1,8 @@
+import os
+import sys
+
+#run from pobvis/ like the benchmarks: app is imported as a package and the server modules import settings from app/
+_pobvis = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in (_pobvis, os.path.join(_pobvis, "app")):
+    if path not in sys.path:
+        sys.path.insert(0, path)
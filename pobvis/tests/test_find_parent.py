@@ -0,0 +1,97 @@
+"""
+The tree built by parse() (find_parent over a ParentIndex) against the
+linear search find_parent did before, on generated traces.
+"""
+import io
+import random
+import pytest
+from app.utils.trace_parsing import parse, TraceParser, EType
+from benchmarks import trace_gen
+
+def linear_find_parent(event, all_events):
+    #find_parent as it was, walking back through all the events before
+    if event.event_type == EType.ADD_LEM:
+        if all_events[-1].event_type == EType.EXP_POB:
+            return all_events[-1]
+        for e in reversed(all_events):
+            if e.event_type == EType.PRO_LEM:
+                return e
+    elif event.event_type == EType.EXP_POB:
+        prev_event = all_events[-1]
+        if prev_event.event_type == EType.EXP_POB and prev_event.level == event.level + 1:
+            return prev_event
+        for e in reversed(all_events):
+            if e.event_type == EType.EXP_LVL:
+                return e
+            elif e.event_type == EType.EXP_POB and e.level > event.level:
+                return e
+    elif event.event_type == EType.PRO_LEM:
+        for e in reversed(all_events):
+            if e.event_type == EType.EXP_LVL:
+                return e
+    return all_events[0]
+
+def random_trace(seed, events):
+    """
+    Events in any order: pobs and lemmas before the first LEVEL line, pob_ids
+    repeated on other levels, levels going down as well as up
+    """
+    rng = random.Random(seed)
+    pob_ids = [rng.randrange(1, 20) for _ in range(5)]
+    out = []
+    for i in range(events):
+        kind = rng.random()
+        if kind < 0.1:
+            out.append("* LEVEL {}".format(rng.randrange(6)))
+        elif kind < 0.6:
+            pob_id = rng.choice(pob_ids + ["none"])
+            out.append("** expand-pob: P{} level: {} depth: {} exprID: {} pobID: {}\n(x{} 0)".format(
+                rng.randrange(3), rng.randrange(6), rng.randrange(4), i, pob_id, i % 7))
+        elif kind < 0.9:
+            level = rng.choice(["oo", str(rng.randrange(6))])
+            out.append("** add-lemma: {} exprID: {} pobID: {}\nP{}\n(y{} 1)".format(
+                level, i, rng.choice(pob_ids), rng.randrange(3), i % 5))
+        else:
+            out.append("Propagating to level {}".format(rng.randrange(6)))
+    return "".join(event + "\n\n" for event in out)
+
+def generated_trace(seed, events):
+    out = io.StringIO()
+    trace_gen.generate(out, events, levels=5, max_depth=4, seed=seed)
+    return out.getvalue()
+
+def pobs_before_level(seed, events):
+    #a descent before the first LEVEL line, then a regular trace
+    head = ("** expand-pob: P0 level: 2 depth: 0 exprID: 1 pobID: none\n(x0 0)\n\n"
+            "** expand-pob: P1 level: 1 depth: 1 exprID: 2 pobID: 1\n(x1 0)\n\n"
+            "** add-lemma: 1 exprID: 3 pobID: 2\nP1\n(x1 1)\n\n"
+            "** expand-pob: P0 level: 3 depth: 0 exprID: 4 pobID: 1\n(x0 1)\n\n")
+    return head + generated_trace(seed, events)
+
+def check_tree(text):
+    lines = text.splitlines(keepends=True)
+    nodes = parse(lines)
+    parser = TraceParser()
+    parser.feed(lines)
+    events = parser.all_events
+    assert len(nodes) == len(events)
+    for i in range(1, len(events)):
+        expected = linear_find_parent(events[i], events[:i]).idx
+        assert nodes[i]["parent"] == expected, "event {}: {}".format(i, nodes[i])
+    children = {idx: [] for idx in nodes}
+    for idx in sorted(nodes):
+        if idx != 0:
+            children[nodes[idx]["parent"]].append(idx)
+    assert all(nodes[idx]["children"] == children[idx] for idx in nodes)
+
+@pytest.mark.parametrize("seed", range(5))
+def test_generated_traces(seed):
+    check_tree(generated_trace(seed, 3000))
+
+@pytest.mark.parametrize("seed", range(5))
+def test_pobs_before_first_level(seed):
+    check_tree(pobs_before_level(seed, 1000))
+
+@pytest.mark.parametrize("seed", range(20))
+def test_random_traces(seed):
+    check_tree(random_trace(seed, 1000))